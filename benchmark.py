@@ -0,0 +1,546 @@
+"""
+Benchmark แบบ offline ไม่ต้องใช้เครื่องพิมพ์จริง, Google service account หรือ LINE token
+
+จำลอง:
+  - เครื่องพิมพ์ (HTTP server ที่เสิร์ฟหน้า img.tonerremain พร้อม latency/failure ที่กำหนดได้)
+  - SNMP agent ของเครื่องพิมพ์ (UDP ตอบ Printer-MIB / HOST-RESOURCES-MIB)
+  - Google Sheets (client ปลอมที่จำลอง latency ของ append_rows)
+  - LINE Messaging API (HTTP server รับ push/multicast)
+
+ตัวอย่าง:
+    python benchmark.py
+    python benchmark.py --scenario sweep --printers 2,50,500 --printer-latency 0.3
+    python benchmark.py --scenario broadcast --users 10,1000,10000
+    python benchmark.py --scenario endpoints --duration 5
+    python benchmark.py --scenario probe --printers 50,500
+    python benchmark.py --scenario snmp-check
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+MAX_INK = 50
+
+
+# ---- Fake printer ----
+
+class FakePrinterHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.latency)
+        roll = random.random()
+        if roll < server.failure_rate / 2:
+            # จำลองเครื่องค้าง: ตอบช้ากว่า timeout
+            time.sleep(server.hang_seconds)
+        elif roll < server.failure_rate:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        heights = [random.randint(0, MAX_INK) for _ in range(4)]
+        body = (
+            "<html><head><title>Printer status</title></head><body><table>"
+            + "".join(
+                f'<tr><td>{color}</td><td><img class="tonerremain" height="{height}" src="/ink.gif"></td></tr>'
+                for color, height in zip(["M", "C", "Y", "BK"], heights)
+            )
+            + "</table>" + "<p>padding</p>" * 200 + "</body></html>"
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# ---- Fake SNMP agent ----
+
+class FakeSnmpHandler(socketserver.BaseRequestHandler):
+    """
+    ตอบ SNMP GET ด้วยระดับหมึกสุ่ม community "printer-<i>" ระบุเครื่อง
+    เครื่องที่ i % unsupported_every == 0 ตอบ noSuchObject (ทดสอบการกลับไปใช้หน้าเว็บ)
+    """
+
+    def handle(self):
+        data, sock = self.request
+        server = self.server
+        main = server.main
+        message = main.decode_snmp_message(data)
+        time.sleep(server.latency)
+        if random.random() < server.failure_rate:
+            return  # จำลองเครื่องไม่ตอบ
+        index = int(message["community"].rsplit("-", 1)[-1])
+        unsupported = server.unsupported_every and index % server.unsupported_every == 0
+
+        varbinds = []
+        for oid, _ in message["varbinds"]:
+            if unsupported:
+                value = main.NO_SUCH_OBJECT
+            elif oid.startswith(main.OID_SUPPLY_LEVEL + "."):
+                value = random.randint(0, MAX_INK)
+            elif oid.startswith(main.OID_SUPPLY_MAX + "."):
+                value = MAX_INK
+            elif oid == main.OID_DEVICE_STATUS:
+                value = server.device_status
+            elif oid == main.OID_PRINTER_STATUS:
+                value = 3  # idle
+            else:
+                value = main.NO_SUCH_OBJECT
+            varbinds.append((oid, value))
+        with server.lock:
+            server.requests += 1
+        sock.sendto(main.encode_snmp_message(
+            main.SNMP_RESPONSE, message["request_id"], message["community"], varbinds
+        ), self.client_address)
+
+
+def start_snmp_agent(main, **attrs):
+    server = socketserver.ThreadingUDPServer(("127.0.0.1", 0), FakeSnmpHandler)
+    server.daemon_threads = True
+    server.main = main
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.device_status = 2  # running
+    for key, value in attrs.items():
+        setattr(server, key, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ---- Fake LINE ----
+
+class FakeLineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            status = 429 if random.random() < server.throttle_rate else 200
+            if status == 200:
+                server.recipients += len(body.get("to", [])) if isinstance(body.get("to"), list) else 1
+        payload = b"{}"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+# ---- Fake Google Sheets ----
+
+class FakeWorksheet:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def append_row(self, row, value_input_option=None):
+        self.append_rows([row], value_input_option)
+
+    def append_rows(self, rows, value_input_option=None):
+        time.sleep(self.backend.latency)
+        with self.backend.lock:
+            self.backend.calls += 1
+            self.backend.rows.setdefault(self.name, []).extend(rows)
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def worksheet(self, name):
+        time.sleep(self.backend.latency)
+        with self.backend.lock:
+            self.backend.calls += 1
+        return FakeWorksheet(self.backend, name)
+
+
+class FakeSheetsClient:
+    def __init__(self, latency=0.3):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.rows = {}
+
+    def open_by_url(self, url):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+        return FakeSpreadsheet(self)
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # client ตัดการเชื่อมต่อเองเมื่อ timeout ซึ่งเป็นสิ่งที่จำลองไว้อยู่แล้ว
+        pass
+
+
+def start_server(handler, **attrs):
+    server = QuietHTTPServer(("127.0.0.1", 0), handler)
+    server.lock = threading.Lock()
+    for key, value in attrs.items():
+        setattr(server, key, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_main(workdir, args):
+    """import main.py ใน directory ชั่วคราว ให้ DB และ lock file แยกจากของจริง"""
+    os.chdir(workdir)
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "users.db"),
+        "PRINTERS_FILE": os.path.join(workdir, "printers.json"),
+        "LINE_CHANNEL_SECRET": "benchmark-secret",
+        "LINE_ACCESS_TOKEN": "benchmark-token",
+        "SHEET_URL": "https://docs.google.com/spreadsheets/d/benchmark",
+        "MAX_INK": str(MAX_INK),
+        "PRINTER_TIMEOUT": str(args.printer_timeout),
+        "LINE_RETRY_BACKOFF": "0.05",
+        "SCHEDULER_ENABLED": "false",  # ไม่ให้ uvicorn ใน scenario endpoints เริ่ม scheduler จริง
+        "OUTBOX_ENABLED": "false",  # benchmark ระบาย outbox เองด้วย drain_outbox()
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    return main
+
+
+def use_fake_backends(main, sheets, line_server):
+    main.sheet_client_factory = lambda: sheets
+    main._reset_sheet_client()
+    main._reset_worksheets()
+    main.get_line_configuration().host = f"http://127.0.0.1:{line_server.server_port}"
+    main._line_api = None
+
+
+def make_printers(main, printer_server, count, snmp_agent=None):
+    printers = {}
+    for i in range(count):
+        entry = {
+            "name": f"Bench_{i}",
+            "url": f"http://127.0.0.1:{printer_server.server_port}/printer/{i}",
+            "worksheet": f"Bench_{i}",
+        }
+        if snmp_agent is not None:
+            entry.update({
+                "probe": "snmp",
+                "snmp_port": snmp_agent.server_address[1],
+                "snmp_community": f"printer-{i}",
+            })
+        printers[entry["name"]] = main._make_printer(entry)
+    return printers
+
+
+def set_users(main, count):
+    conn = main.get_db()
+    with conn:
+        conn.execute("DELETE FROM users")
+    main._invalidate_users()
+    main.import_users([(f"U{i:032x}", None) for i in range(count)])
+
+
+def drain_outbox(main):
+    """ส่งงานใน outbox จนหมด (benchmark ไม่ได้เริ่ม outbox worker)"""
+    while main.drain_outbox(flush=True):
+        pass
+
+
+# ---- Scenarios ----
+
+_stdout = sys.stdout
+
+
+def report(*args, **kwargs):
+    """พิมพ์ผล benchmark (log ของ main.py ถูกปิดไว้ระหว่างวัดผล)"""
+    print(*args, file=_stdout, flush=True, **kwargs)
+
+
+def scenario_sweep(main, args, printer_server, sheets, line_server):
+    report("\n== Full sweep (poll_printers + drain Sheets outbox) ==")
+    report(f"{'printers':>9} {'sweep s':>9} {'drain s':>9} {'ok':>5} {'sheet calls':>12}")
+    set_users(main, 10)
+    for count in args.printers:
+        main.PRINTERS = make_printers(main, printer_server, count)
+        printers = list(main.PRINTERS.values())
+        calls_before = sheets.calls
+
+        started = time.perf_counter()
+        results = main.poll_printers(printers)
+        sweep = time.perf_counter() - started
+
+        started = time.perf_counter()
+        drain_outbox(main)
+        drain = time.perf_counter() - started
+
+        ok = sum(1 for result in results if result["success"])
+        report(f"{count:>9} {sweep:>9.2f} {drain:>9.2f} {ok:>5} {sheets.calls - calls_before:>12}")
+
+
+def scenario_broadcast(main, args, printer_server, sheets, line_server):
+    report("\n== Broadcast (07:00 flex + text) ==")
+    report(f"{'users':>7} {'flex s':>8} {'text s':>8} {'requests':>9} {'delivered':>10}")
+    main.PRINTERS = make_printers(main, printer_server, 2)
+    printer_data = [(printer, [100, 60, 30, 10]) for printer in main.PRINTERS.values()]
+    for count in args.users:
+        set_users(main, count)
+        requests_before = line_server.requests
+        recipients_before = line_server.recipients
+
+        started = time.perf_counter()
+        main.handle_flex_message(printer_data)
+        drain_outbox(main)
+        flex = time.perf_counter() - started
+
+        started = time.perf_counter()
+        main.send_text_message("benchmark")
+        drain_outbox(main)
+        text = time.perf_counter() - started
+
+        report(f"{count:>7} {flex:>8.2f} {text:>8.2f} "
+              f"{line_server.requests - requests_before:>9} {line_server.recipients - recipients_before:>10}")
+
+
+def scenario_probe(main, args, printer_server, sheets, line_server):
+    report("\n== Probe (HTML scrape vs SNMP) ==")
+    report(f"{'printers':>9} {'html s':>8} {'snmp s':>8} {'ok':>5} {'snmp pkts':>10} {'fallback':>9}")
+    snmp_agent = start_snmp_agent(
+        main, latency=args.snmp_latency, failure_rate=args.printer_failure_rate,
+        unsupported_every=args.snmp_unsupported_every
+    )
+    for count in args.printers:
+        main.PRINTERS = make_printers(main, printer_server, count)
+        started = time.perf_counter()
+        main.poll_printers(list(main.PRINTERS.values()))
+        html = time.perf_counter() - started
+
+        main.PRINTERS = make_printers(main, printer_server, count, snmp_agent)
+        main._snmp_skip_until.clear()
+        requests_before = snmp_agent.requests
+        started = time.perf_counter()
+        results = main.poll_printers(list(main.PRINTERS.values()))
+        snmp = time.perf_counter() - started
+
+        ok = sum(1 for result in results if result["success"])
+        fallback = sum(1 for result in results if result["success"] and "device" not in result)
+        report(f"{count:>9} {html:>8.2f} {snmp:>8.2f} {ok:>5} "
+               f"{snmp_agent.requests - requests_before:>10} {fallback:>9}")
+    drain_outbox(main)
+    snmp_agent.shutdown()
+
+
+SNMP_REFERENCE_GET = bytes.fromhex(
+    # GET sysDescr.0, community "public", request-id 1 (SNMPv2c)
+    "302602010104067075626c6963a019020101020100020100300e300c06082b060102010101000500"
+)
+
+
+def scenario_snmp_check(main, args, printer_server, sheets, line_server):
+    """ตรวจความถูกต้องของ BER encoder/decoder และการกลับไปใช้หน้าเว็บ (ผิดพลาดจะ raise)"""
+    report("\n== SNMP checks ==")
+    assert main.encode_snmp_message(main.SNMP_GET, 1, "public", [("1.3.6.1.2.1.1.1.0", None)]) == SNMP_REFERENCE_GET
+    assert main.decode_snmp_message(SNMP_REFERENCE_GET)["varbinds"] == [("1.3.6.1.2.1.1.1.0", None)]
+
+    varbinds = [
+        ("1.3.6.1.2.1.43.11.1.1.9.1.1", 0),
+        ("1.3.6.1.2.1.43.11.1.1.9.1.2", 127),
+        ("1.3.6.1.2.1.43.11.1.1.9.1.3", 128),
+        ("1.3.6.1.2.1.43.11.1.1.9.1.4", -3),
+        ("1.3.6.1.4.1.2699.1.2.1.2.1.1.3.16383", 2 ** 31 - 1),
+        ("1.3.6.1.2.1.25.3.2.1.3.1", b"Printer"),
+        ("1.3.6.1.2.1.25.3.2.1.5.1", main.NO_SUCH_OBJECT),
+    ] * 8  # ยาวเกิน 127 byte เพื่อทดสอบ length แบบยาว
+    for pdu_type, request_id in ((main.SNMP_GET, 1), (main.SNMP_RESPONSE, 0x7FFFFFFF)):
+        message = main.decode_snmp_message(
+            main.encode_snmp_message(pdu_type, request_id, "printer-1", varbinds, error_status=2)
+        )
+        assert message["pdu_type"] == pdu_type
+        assert message["request_id"] == request_id
+        assert message["community"] == "printer-1"
+        assert message["error_status"] == 2
+        assert message["varbinds"] == varbinds, message["varbinds"]
+    report("BER round trip: ok")
+
+    main._snmp_skip_until.clear()
+    agent = start_snmp_agent(main, latency=0, failure_rate=0, unsupported_every=0)
+    printer = make_printers(main, printer_server, 1, agent)["Bench_0"]
+    printer_server.failure_rate = 0
+    result = main.checkNetworkPrinter(printer)
+    assert result["success"] and "device" in result, result
+
+    agent.device_status = 5  # down
+    result = main.checkNetworkPrinter(printer)
+    assert not result["success"] and result["sample"]["status"] == main.STATUS_PING["fault"], result
+    report("device status down -> failed poll: ok")
+
+    agent.unsupported_every = 1  # ทุก OID ตอบ noSuchObject
+    result = main.checkNetworkPrinter(printer)
+    assert result["success"] and "device" not in result, result
+    assert main._snmp_skip_until.get(printer["name"], 0) > time.time()
+    requests_before = agent.requests
+    assert main.checkNetworkPrinter(printer)["success"] and agent.requests == requests_before
+    report("noSuchObject -> web page fallback: ok")
+
+    main._snmp_skip_until.clear()
+    agent.unsupported_every = 0
+    agent.failure_rate = 1  # ไม่ตอบ
+    result = main.checkNetworkPrinter(printer)
+    assert result["success"] and "device" not in result, result
+    assert printer["name"] not in main._snmp_skip_until
+    report("no response -> web page fallback: ok")
+    printer_server.failure_rate = args.printer_failure_rate
+    agent.shutdown()
+
+
+def scenario_endpoints(main, args, printer_server, sheets, line_server):
+    import uvicorn
+
+    report("\n== Endpoint throughput ==")
+    main.PRINTERS = make_printers(main, printer_server, 2)
+    set_users(main, 1000)
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    base = f"http://127.0.0.1:{args.port}"
+    while not server.started:
+        time.sleep(0.05)
+    main.poll_printers(list(main.PRINTERS.values()))  # /status อ่านผลของรอบนี้
+
+    import base64
+    import hashlib
+    import hmac
+    webhook_body = json.dumps({"destination": "x", "events": [
+        {"type": "follow", "source": {"type": "user", "userId": "Ubenchmark"}}
+    ]})
+    webhook_signature = base64.b64encode(
+        hmac.new(b"benchmark-secret", webhook_body.encode(), hashlib.sha256).digest()
+    ).decode()
+
+    targets = {
+        "/status": lambda session: session.get(f"{base}/status"),
+        "/users": lambda session: session.get(f"{base}/users"),
+        "/printers": lambda session: session.get(f"{base}/printers"),
+        "/webhook": lambda session: session.post(
+            f"{base}/webhook", data=webhook_body,
+            headers={"X-Line-Signature": webhook_signature, "Content-Type": "application/json"}
+        ),
+    }
+
+    report(f"{'endpoint':>10} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'errors':>7}")
+    for name, call in targets.items():
+        latencies = []
+        errors = [0]
+        deadline = time.perf_counter() + args.duration
+
+        def worker():
+            session = requests.Session()
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if call(session).status_code >= 400:
+                        errors[0] += 1
+                except requests.RequestException:
+                    errors[0] += 1
+                latencies.append(time.perf_counter() - started)
+
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            for _ in range(args.concurrency):
+                executor.submit(worker)
+
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        report(f"{name:>10} {len(latencies) / args.duration:>9.0f} {p50:>8.1f} {p95:>8.1f} {errors[0]:>7}")
+
+    server.should_exit = True
+    server_thread.join(timeout=5)
+
+
+SCENARIOS = {
+    "sweep": scenario_sweep,
+    "broadcast": scenario_broadcast,
+    "endpoints": scenario_endpoints,
+    "probe": scenario_probe,
+    "snmp-check": scenario_snmp_check,
+}
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for checkstatusprinter")
+    parser.add_argument("--scenario", choices=["all", *SCENARIOS], default="all")
+    parser.add_argument("--printers", type=int_list, default=[2, 50, 500])
+    parser.add_argument("--users", type=int_list, default=[10, 100, 1000, 10000])
+    parser.add_argument("--printer-latency", type=float, default=0.2)
+    parser.add_argument("--printer-failure-rate", type=float, default=0.05)
+    parser.add_argument("--printer-timeout", type=float, default=2)
+    parser.add_argument("--sheets-latency", type=float, default=0.3)
+    parser.add_argument("--snmp-latency", type=float, default=0.005)
+    parser.add_argument("--snmp-unsupported-every", type=int, default=10,
+                        help="ทุกเครื่องที่ i %% N == 0 ไม่รองรับ SNMP (0 = รองรับทุกเครื่อง)")
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    parser.add_argument("--line-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="printer-bench-")
+    started = time.perf_counter()
+    main_module = load_main(workdir, args)
+    print(f"import main: {time.perf_counter() - started:.2f} s (workdir {workdir})")
+    print(f"startup: {main_module.get_startup_timings()}")
+
+    printer_server = start_server(
+        FakePrinterHandler, latency=args.printer_latency,
+        failure_rate=args.printer_failure_rate, hang_seconds=args.printer_timeout * 2
+    )
+    line_server = start_server(
+        FakeLineHandler, latency=args.line_latency,
+        throttle_rate=args.line_throttle_rate, requests=0, recipients=0
+    )
+    sheets = FakeSheetsClient(latency=args.sheets_latency)
+    use_fake_backends(main_module, sheets, line_server)
+
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in names:
+            SCENARIOS[name](main_module, args, printer_server, sheets, line_server)
+
+    print("\n== Stage timings (/stats) ==")
+    for stage, stats in main_module.get_stats().items():
+        print(f"{stage:>22} count={stats['count']:<6} avg={stats['avg'] * 1000:8.1f} ms "
+              f"p95={stats['p95'] * 1000:8.1f} ms errors={stats['errors']}")
+
+
+if __name__ == "__main__":
+    main()
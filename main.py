@@ -1,24 +1,36 @@
-from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-from oauth2client.service_account import ServiceAccountCredentials
-from datetime import datetime
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+# import เฉพาะที่จำเป็นตอนเริ่มต้น ส่วน library ที่หนัก (gspread, LINE SDK, lxml, numpy,
+# apscheduler) จะ import ในฟังก์ชันที่ใช้งานครั้งแรก เพื่อให้ start container/worker ได้เร็ว
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import pytz
 import os
-import gspread
 import requests
-from bs4 import BeautifulSoup
-from linebot.v3.messaging import (
-    Configuration, ApiClient, MessagingApi, PushMessageRequest,
-    TextMessage, FlexMessage, FlexContainer
-)
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 import logging
 import json
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
-from linebot.v3 import WebhookHandler
+import asyncio
+import csv
+import io
+from fastapi import FastAPI, Request, Form, File, UploadFile, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
 import sqlite3
+import threading
+import fcntl
+import contextlib
+import uuid
+import random
+import bisect
+import itertools
+import functools
+import hashlib
+import hmac
+import base64
+from collections import deque
 
 app = FastAPI()
 logging.basicConfig(level=logging.INFO)
@@ -32,28 +44,286 @@ STATUS_PING = {
     "success": "Success",
     "timeout": "Request Timeout",
     "error": "Host unreachable / Error",
+    "fault": "Printer fault",  # ติดต่อได้แต่เครื่องรายงานว่าใช้งานไม่ได้ (SNMP hrDeviceStatus = down)
 }
-printer_1_url = os.getenv("PRINTER_1")
-printer_2_url = os.getenv("PRINTER_2")
+# ไฟล์ทะเบียนเครื่องพิมพ์ (ดูตัวอย่างใน printers.example.json)
+PRINTERS_FILE = os.getenv("PRINTERS_FILE", "printers.json")
+LAB_NAME = os.getenv("LAB_NAME", "LAB2")
+DEFAULT_POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "3600"))
+LOW_INK_THRESHOLD = int(os.getenv("LOW_INK_THRESHOLD", "10"))
+# ช่วงเวลาที่ตรวจสอบเครื่องพิมพ์ (รูปแบบ CronTrigger) เครื่องไหนต่างออกไปกำหนดใน printers.json ได้
+POLL_HOURS = os.getenv("POLL_HOURS", "7-16")
+POLL_DAYS = os.getenv("POLL_DAYS", "mon-fri")
 
-worksheet_printer_1 = os.getenv("WORKSHEET_PRINTER_1")
-worksheet_printer_2 = os.getenv("WORKSHEET_PRINTER_2")
+# timeout ต่อเครื่อง (วินาที) และจำนวน thread สูงสุดที่ใช้ตรวจสอบเครื่องพิมพ์พร้อมกัน
+PRINTER_TIMEOUT = float(os.getenv("PRINTER_TIMEOUT", "10"))
+POLL_MAX_WORKERS = int(os.getenv("POLL_MAX_WORKERS", "16"))
+
+# วิธีอ่านสถานะเครื่องพิมพ์: "html" (หน้าเว็บ) หรือ "snmp" (Printer-MIB ถ้าไม่ได้จะกลับไปใช้หน้าเว็บ)
+PRINTER_PROBE = os.getenv("PRINTER_PROBE", "html")
+PRINTER_PROBES = ("html", "snmp")
+SNMP_PORT = int(os.getenv("SNMP_PORT", "161"))
+SNMP_COMMUNITY = os.getenv("SNMP_COMMUNITY", "public")
 
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_ACCESS_TOKEN")
 
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+GOOGLE_CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE", "credentials.json")
+# สร้าง gspread client ใหม่เป็นระยะ (token ของ service account มีอายุ 1 ชั่วโมง)
+SHEET_CLIENT_TTL = float(os.getenv("SHEET_CLIENT_TTL", "3000"))
+
+_line_configuration = None
+_sheet_client = None
+_sheet_client_expires = 0.0
+_clients_lock = threading.Lock()
+
+def get_line_configuration():
+    """Configuration ของ LINE Messaging API (สร้างครั้งแรกที่ใช้งาน)"""
+    global _line_configuration
+    with _clients_lock:
+        if _line_configuration is None:
+            from linebot.v3.messaging import Configuration
+            _line_configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+        return _line_configuration
+
+def _authorize_sheets():
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_CREDENTIALS_FILE, SCOPES)
+    return gspread.authorize(credentials)
+
+# เปลี่ยนเป็น factory อื่นได้ (เช่น benchmark.py ใช้ Sheets ปลอม)
+sheet_client_factory = _authorize_sheets
+
+def get_sheet_client():
+    """gspread client ที่ cache ไว้ สร้างใหม่เมื่อครบ SHEET_CLIENT_TTL หรือหลังเขียนไม่สำเร็จ"""
+    global _sheet_client, _sheet_client_expires
+    with _clients_lock:
+        if _sheet_client is None or time.monotonic() >= _sheet_client_expires:
+            _sheet_client = sheet_client_factory()
+            _sheet_client_expires = time.monotonic() + SHEET_CLIENT_TTL
+        return _sheet_client
+
+def _reset_sheet_client():
+    global _sheet_client
+    with _clients_lock:
+        _sheet_client = None
+
+def verify_signature(body, signature):
+    """ตรวจ X-Line-Signature (HMAC-SHA256 ของ body ด้วย channel secret)"""
+    if not LINE_CHANNEL_SECRET or not signature:
+        return False
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode('utf-8'))
+
+def _make_printer(entry):
+    """เติมค่า default ให้ข้อมูลเครื่องพิมพ์หนึ่งเครื่องจากไฟล์ทะเบียน"""
+    return {
+        "name": entry["name"],
+        "url": entry["url"],
+        "worksheet": entry.get("worksheet") or entry["name"],
+        "lab": entry.get("lab") or LAB_NAME,
+        "profile": entry.get("profile") or "default",
+        "poll_interval": int(entry.get("poll_interval") or DEFAULT_POLL_INTERVAL),
+        "low_ink_threshold": int(entry.get("low_ink_threshold", LOW_INK_THRESHOLD)),
+        "adaptive": bool(entry.get("adaptive", True)),
+        "poll_hours": str(entry.get("poll_hours") or POLL_HOURS),
+        "poll_days": entry.get("poll_days") or POLL_DAYS,
+        "probe": entry.get("probe") or PRINTER_PROBE,
+        "snmp_host": entry.get("snmp_host") or urlparse(entry["url"]).hostname,
+        "snmp_port": int(entry.get("snmp_port") or SNMP_PORT),
+        "snmp_community": entry.get("snmp_community") or SNMP_COMMUNITY,
+        # prtMarkerSuppliesIndex ของหมึกแต่ละสี เรียงตาม M, C, Y, BK
+        "snmp_supplies": [int(index) for index in entry.get("snmp_supplies") or [1, 2, 3, 4]],
+    }
+
+def load_printers(path=PRINTERS_FILE):
+    """
+    โหลดทะเบียนเครื่องพิมพ์ คืนค่า dict {name: printer} ตามลำดับในไฟล์
+    ถ้าไม่มีไฟล์ จะใช้ PRINTER_1/PRINTER_2 จาก .env แบบเดิม
+    """
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+    else:
+        entries = []
+        for i in (1, 2):
+            url = os.getenv(f"PRINTER_{i}")
+            if url:
+                entries.append({
+                    "name": f"Printer_{i}",
+                    "url": url,
+                    "worksheet": os.getenv(f"WORKSHEET_PRINTER_{i}"),
+                })
+
+    printers = {}
+    for entry in entries:
+        printer = _make_printer(entry)
+        if printer["name"] in printers:
+            raise ValueError(f"Duplicate printer name: {printer['name']}")
+        if printer["probe"] not in PRINTER_PROBES:
+            raise ValueError(f"Unknown probe for {printer['name']}: {printer['probe']}")
+        if printer["profile"] not in SCRAPE_PROFILES:
+            raise ValueError(f"Unknown profile for {printer['name']}: {printer['profile']}")
+        printers[printer["name"]] = printer
+    return printers
+
+def get_printer(name):
+    """ค้นหาเครื่องพิมพ์ตามชื่อ คืนค่า None ถ้าไม่พบ"""
+    return PRINTERS.get(name)
+
+# ---- Metrics ----
+# histogram เวลาที่ใช้ของแต่ละขั้นตอน (scrape, Sheets, LINE) ดูได้ที่ /metrics และ /stats
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = {}
+_counters = {}
+_metrics_lock = threading.Lock()
+
+def observe(stage, seconds, error=False):
+    """บันทึกเวลาที่ใช้ (วินาที) ของขั้นตอนหนึ่งครั้ง"""
+    index = bisect.bisect_left(METRIC_BUCKETS, seconds)
+    with _metrics_lock:
+        metric = _metrics.get(stage)
+        if metric is None:
+            metric = _metrics[stage] = {
+                "count": 0, "errors": 0, "sum": 0.0, "max": 0.0,
+                "buckets": [0] * (len(METRIC_BUCKETS) + 1),
+            }
+        metric["count"] += 1
+        metric["sum"] += seconds
+        metric["max"] = max(metric["max"], seconds)
+        metric["buckets"][index] += 1
+        if error:
+            metric["errors"] += 1
+
+def increment(counter, amount=1):
+    """เพิ่มค่า counter (เช่นจำนวน event ที่ถูกทิ้ง) ดูได้ที่ /metrics และ /stats"""
+    with _metrics_lock:
+        _counters[counter] = _counters.get(counter, 0) + amount
 
-credentials = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", SCOPES)
+def get_counters():
+    with _metrics_lock:
+        return dict(sorted(_counters.items()))
+
+def _is_failure(result):
+    """ผลลัพธ์ที่ถือว่าล้มเหลว: {"success": False} (การส่ง LINE/Sheets ที่ล้มเหลวจะ raise แทน)"""
+    return isinstance(result, dict) and result.get("success") is False
+
+def timed(stage):
+    """decorator จับเวลาฟังก์ชันแล้วบันทึกลง metrics ของ stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                observe(stage, time.perf_counter() - started, error=True)
+                raise
+            observe(stage, time.perf_counter() - started, error=_is_failure(result))
+            return result
+        return wrapper
+    return decorator
+
+def _quantile(metric, q):
+    """ประมาณค่า quantile จาก histogram (ขอบบนของ bucket)"""
+    target = metric["count"] * q
+    cumulative = 0
+    for bound, count in zip(METRIC_BUCKETS + (metric["max"],), metric["buckets"]):
+        cumulative += count
+        if cumulative >= target:
+            return min(bound, metric["max"])
+    return metric["max"]
+
+def get_stats():
+    with _metrics_lock:
+        metrics = {stage: dict(metric, buckets=list(metric["buckets"])) for stage, metric in _metrics.items()}
+    total = sum(metric["sum"] for metric in metrics.values()) or 1.0
+    return {
+        stage: {
+            "count": metric["count"],
+            "errors": metric["errors"],
+            "error_rate": round(metric["errors"] / metric["count"], 4),
+            "total_seconds": round(metric["sum"], 4),
+            "share": round(metric["sum"] / total, 4),
+            "avg": round(metric["sum"] / metric["count"], 4),
+            "p50": round(_quantile(metric, 0.5), 4),
+            "p95": round(_quantile(metric, 0.95), 4),
+            "p99": round(_quantile(metric, 0.99), 4),
+            "max": round(metric["max"], 4),
+        }
+        for stage, metric in sorted(metrics.items())
+    }
 
-client = gspread.authorize(credentials)
+def render_metrics():
+    """metrics ในรูปแบบ Prometheus text exposition"""
+    with _metrics_lock:
+        metrics = {stage: dict(metric, buckets=list(metric["buckets"])) for stage, metric in _metrics.items()}
+    lines = [
+        "# HELP printer_stage_seconds Time spent per stage.",
+        "# TYPE printer_stage_seconds histogram",
+    ]
+    for stage, metric in sorted(metrics.items()):
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS, metric["buckets"]):
+            cumulative += count
+            lines.append(f'printer_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'printer_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {metric["count"]}')
+        lines.append(f'printer_stage_seconds_sum{{stage="{stage}"}} {metric["sum"]}')
+        lines.append(f'printer_stage_seconds_count{{stage="{stage}"}} {metric["count"]}')
+    lines.append("# HELP printer_startup_seconds Seconds from import to each startup phase.")
+    lines.append("# TYPE printer_startup_seconds gauge")
+    for phase, seconds in _startup_timings.items():
+        if seconds is not None:
+            lines.append(f'printer_startup_seconds{{phase="{phase[:-len("_seconds")]}"}} {seconds}')
+    lines.append("# HELP printer_outbox_items Outbox items per kind and status.")
+    lines.append("# TYPE printer_outbox_items gauge")
+    for kind, statuses in sorted(get_outbox_counts().items()):
+        for status, count in sorted(statuses.items()):
+            lines.append(f'printer_outbox_items{{kind="{kind}",status="{status}"}} {count}')
+    lines.append("# HELP printer_events_total Events counted outside of timed stages.")
+    lines.append("# TYPE printer_events_total counter")
+    for counter, value in get_counters().items():
+        lines.append(f'printer_events_total{{event="{counter}"}} {value}')
+    lines.append("# HELP printer_stage_errors_total Failed calls per stage.")
+    lines.append("# TYPE printer_stage_errors_total counter")
+    for stage, metric in sorted(metrics.items()):
+        lines.append(f'printer_stage_errors_total{{stage="{stage}"}} {metric["errors"]}')
+    return "\n".join(lines) + "\n"
 
 # Database path - ใช้ volume หรือ local directory
-DB_PATH = '/app/data/users.db' if os.path.exists('/app/data') else 'users.db'
+DB_PATH = os.getenv("DB_PATH") or ('/app/data/users.db' if os.path.exists('/app/data') else 'users.db')
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+_db_local = threading.local()
+
+def get_db():
+    """
+    คืนค่า connection ของ thread ปัจจุบัน (เปิดครั้งเดียวต่อ thread แล้วใช้ซ้ำ)
+    ใช้ WAL เพื่อให้การอ่าน (เช่นหน้า /users, /history) ไม่ติด lock ตอนเขียน
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+        _ensure_db_initialized(conn)
+    return conn
+
+_db_initialized = False
+_db_init_lock = threading.Lock()
+
+def _ensure_db_initialized(conn):
+    """สร้างตารางครั้งแรกที่มีการเปิด connection (แทนการทำตอน import)"""
+    global _db_initialized
+    with _db_init_lock:
+        if not _db_initialized:
+            init_db(conn)
+            _db_initialized = True
+
+def init_db(conn=None):
+    conn = conn or get_db()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -62,67 +332,688 @@ def init_db():
             name TEXT
         )
     ''')
+    # users_version เพิ่มขึ้นทุกครั้งที่ตาราง users เปลี่ยน (ผ่าน trigger ไม่ว่าจะเขียนจาก process ไหน)
+    # ใช้ตัดสินว่า cache รายชื่อผู้ใช้ยังใช้ได้หรือไม่
+    cursor.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('users_version', 0)")
+    for event in ('INSERT', 'DELETE', 'UPDATE'):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS users_version_{event.lower()} AFTER {event} ON users
+            BEGIN
+                UPDATE meta SET value = value + 1 WHERE key = 'users_version';
+            END
+        ''')
+    # ประวัติระดับหมึก หนึ่งแถวต่อการตรวจสอบหนึ่งครั้ง (ts เป็น unix timestamp)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS samples (
+            id INTEGER PRIMARY KEY,
+            ts INTEGER NOT NULL,
+            printer TEXT NOT NULL,
+            m INTEGER,
+            c INTEGER,
+            y INTEGER,
+            bk INTEGER,
+            status TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_printer_ts ON samples (printer, ts)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_samples_ts ON samples (ts)')
+    # สถานะล่าสุดของแต่ละเครื่อง (ใช้ตัดสินว่าจะแจ้งเตือนหรือไม่)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS printer_state (
+            printer TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            fail_count INTEGER NOT NULL DEFAULT 0,
+            ok_count INTEGER NOT NULL DEFAULT 0,
+            changed_at INTEGER,
+            flap_times TEXT NOT NULL DEFAULT '[]',
+            flapping INTEGER NOT NULL DEFAULT 0,
+            low_colors TEXT NOT NULL DEFAULT '[]'
+        )
+    ''')
+    # ผลการตรวจสอบล่าสุดของแต่ละเครื่อง ใช้ร่วมกันทุก worker process (สำหรับ /status)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS printer_snapshot (
+            printer TEXT PRIMARY KEY,
+            lab TEXT,
+            success INTEGER NOT NULL,
+            levels TEXT NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT,
+            ts INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    # งานที่ต้องส่งออกไปภายนอก (Google Sheets, LINE) รอ outbox worker ส่งพร้อม retry
+    # idem_key กันไม่ให้งานเดียวกันถูกใส่ซ้ำ status: pending -> done หรือ dead (ลองครบแล้วไม่สำเร็จ)
+    # group_key = กลุ่มที่ส่งพร้อมกัน (worksheet ของ sheet_row, batch ของ line_multicast)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            idem_key TEXT UNIQUE NOT NULL,
+            payload TEXT NOT NULL,
+            group_key TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    # outbox ของเวอร์ชันก่อนยังไม่มี group_key เพิ่มคอลัมน์และเติมค่าจาก payload
+    if 'group_key' not in [row[1] for row in cursor.execute('PRAGMA table_info(outbox)')]:
+        cursor.execute('ALTER TABLE outbox ADD COLUMN group_key TEXT')
+        cursor.execute(
+            "UPDATE outbox SET group_key = CAST(json_extract(payload, "
+            "CASE kind WHEN 'sheet_row' THEN '$.sheet' ELSE '$.batch' END) AS TEXT)"
+        )
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_group ON outbox (status, kind, group_key, id)')
+    # สรุปรายวัน/รายสัปดาห์ต่อเครื่อง (period = 'day' หรือ 'week', bucket = วันที่เริ่มต้น YYYY-MM-DD)
+    # เก็บเป็นผลรวมเพื่อให้อัปเดตทีละ sample ได้ ค่าเฉลี่ย = *_sum / level_count
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollups (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            printer TEXT NOT NULL,
+            polls INTEGER NOT NULL DEFAULT 0,
+            ok_polls INTEGER NOT NULL DEFAULT 0,
+            unreachable INTEGER NOT NULL DEFAULT 0,
+            level_count INTEGER NOT NULL DEFAULT 0,
+            m_min INTEGER, c_min INTEGER, y_min INTEGER, bk_min INTEGER,
+            m_sum INTEGER NOT NULL DEFAULT 0, c_sum INTEGER NOT NULL DEFAULT 0,
+            y_sum INTEGER NOT NULL DEFAULT 0, bk_sum INTEGER NOT NULL DEFAULT 0,
+            m_used INTEGER NOT NULL DEFAULT 0, c_used INTEGER NOT NULL DEFAULT 0,
+            y_used INTEGER NOT NULL DEFAULT 0, bk_used INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (period, bucket, printer)
+        ) WITHOUT ROWID
+    ''')
+    # เวอร์ชันก่อนบันทึกระดับหมึกของรอบที่อ่านไม่ได้เป็น 0 แปลงเป็น NULL ครั้งเดียว
+    if cursor.execute('PRAGMA user_version').fetchone()[0] < 1:
+        cursor.execute(
+            'UPDATE samples SET m = NULL, c = NULL, y = NULL, bk = NULL WHERE status IN (?, ?)',
+            (STATUS_PING["timeout"], STATUS_PING["error"])
+        )
+        cursor.execute('PRAGMA user_version = 1')
     conn.commit()
-    conn.close()
+
+# ---- Multi-process ----
+# รัน API ได้หลาย worker (WEB_CONCURRENCY) โดยมี scheduler เพียงตัวเดียว
+# worker ที่ได้ file lock (flock) ของ scheduler.lock เป็น leader ส่วนตัวอื่นลองใหม่ทุก LEADER_RETRY_SECONDS
+# outbox worker เลือก leader แยกด้วย outbox.lock จึงส่งงานได้แม้ปิด scheduler (SCHEDULER_ENABLED=false)
+# lock จะถูกปล่อยเองเมื่อ process ตาย worker อื่นจึงขึ้นมาแทนได้
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() == "true"
+LEADER_RETRY_SECONDS = float(os.getenv("LEADER_RETRY_SECONDS", "30"))
+LOCK_DIR = os.getenv("LOCK_DIR", os.path.dirname(DB_PATH) or ".")
+
+_leader_files = {}
+_process_locks = {}
+_process_locks_guard = threading.Lock()
+
+def _lock_path(name):
+    return os.path.join(LOCK_DIR, f"{name}.lock")
+
+def try_become_leader(role="scheduler"):
+    """พยายามถือ lock ของ role (scheduler หรือ outbox) แบบไม่รอ คืนค่า True ถ้า process นี้เป็น leader"""
+    if role in _leader_files:
+        return True
+    f = open(_lock_path(role), "a+")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _leader_files[role] = f
+    return True
+
+def is_leader(role="scheduler"):
+    return role in _leader_files
+
+@contextlib.contextmanager
+def process_lock(name, blocking=True):
+    """
+    lock ข้าม process ด้วย flock (และข้าม thread ภายใน process เดียวกัน)
+    เรียกซ้อนใน thread เดิมได้ คืนค่า False ถ้า blocking=False แล้วมีคนถืออยู่
+    """
+    with _process_locks_guard:
+        entry = _process_locks.setdefault(name, {"lock": threading.RLock(), "file": None, "depth": 0})
+    if not entry["lock"].acquire(blocking=blocking):
+        yield False
+        return
+    try:
+        if entry["depth"] == 0:
+            if entry["file"] is None:
+                entry["file"] = open(_lock_path(name), "a+")
+            try:
+                fcntl.flock(entry["file"].fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+        entry["depth"] += 1
+        try:
+            yield True
+        finally:
+            entry["depth"] -= 1
+            if entry["depth"] == 0:
+                fcntl.flock(entry["file"].fileno(), fcntl.LOCK_UN)
+    finally:
+        entry["lock"].release()
+
+def run_exclusive(name, func):
+    """
+    รัน func ถ้าไม่มี process อื่นกำลังรันงานชื่อเดียวกันอยู่
+    ถ้ามี จะรอให้งานนั้นเสร็จแล้วคืนค่า None แทนการรันซ้ำ
+    """
+    with process_lock(name, blocking=False) as acquired:
+        if acquired:
+            return func()
+    with process_lock(name):
+        return None
+
+# ---- Users ----
+# รายชื่อผู้ใช้ทั้งหมดถูก cache ไว้ในหน่วยความจำ (ใช้ทุกครั้งที่ broadcast)
+# และจะถูกล้างเมื่อมีการเพิ่ม/ลบผู้ใช้ใน process นี้
+# การเปลี่ยนจาก process อื่นตรวจด้วย PRAGMA data_version (ไม่อ่านตาราง) แล้วจึงอ่าน users_version
+_users_cache = None
+_users_cache_version = None
+_users_lock = threading.Lock()
+
+def _invalidate_users():
+    global _users_cache
+    with _users_lock:
+        _users_cache = None
 
 def add_user(user_id, name=None):
     """เพิ่มผู้ใช้ใหม่"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    conn = get_db()
     try:
-        cursor.execute('INSERT INTO users (user_id, name) VALUES (?, ?)', (user_id, name))
-        conn.commit()
-        return True
+        with conn:
+            conn.execute('INSERT INTO users (user_id, name) VALUES (?, ?)', (user_id, name))
     except sqlite3.IntegrityError:
-        return False 
-    finally:
-        conn.close()
+        return False
+    _invalidate_users()
+    return True
+
+def _users_cache_fresh(conn):
+    """
+    ตรวจว่า cache ยังตรงกับตาราง users (ต้องถือ _users_lock) คืนค่า (fresh, users_version, data_version)
+    data_version ของ connection จะเปลี่ยนเมื่อ connection อื่นเขียน DB ถ้าไม่เปลี่ยนก็ไม่ต้องอ่าน users_version
+    """
+    data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+    if _users_cache is not None and getattr(_db_local, "users_data_version", None) == data_version:
+        return True, _users_cache_version, data_version
+    version = conn.execute("SELECT value FROM meta WHERE key = 'users_version'").fetchone()[0]
+    fresh = _users_cache is not None and version == _users_cache_version
+    if fresh:
+        _db_local.users_data_version = data_version
+    return fresh, version, data_version
 
 def get_all_users():
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, name FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    return users
+    """คืนค่า [(user_id, name), ...] ทั้งหมดจาก cache (ห้ามแก้ไข list ที่ได้กลับไป)"""
+    global _users_cache, _users_cache_version
+    conn = get_db()
+    with _users_lock:
+        fresh, version, data_version = _users_cache_fresh(conn)
+        if not fresh:
+            _users_cache = conn.execute('SELECT user_id, name FROM users ORDER BY id').fetchall()
+            _users_cache_version = version
+            _db_local.users_data_version = data_version
+        return _users_cache
+
+def count_users():
+    """จำนวนผู้ใช้ (จาก cache ถ้ายังใช้ได้ ไม่งั้นนับใน DB โดยไม่โหลดรายชื่อทั้งหมด)"""
+    conn = get_db()
+    with _users_lock:
+        if _users_cache_fresh(conn)[0]:
+            return len(_users_cache)
+    return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+def get_users_page(page=1, page_size=50):
+    """ดึงผู้ใช้ทีละหน้า (page เริ่มที่ 1) คืนค่า [(user_id, name), ...]"""
+    offset = (max(page, 1) - 1) * page_size
+    return get_db().execute(
+        'SELECT user_id, name FROM users ORDER BY id LIMIT ? OFFSET ?',
+        (page_size, offset)
+    ).fetchall()
 
 def delete_user(user_id):
-    conn = sqlite3.connect('users.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-    deleted = cursor.rowcount > 0
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        deleted = conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,)).rowcount > 0
+    if deleted:
+        _invalidate_users()
+    return deleted
+
+def import_users(users):
+    """เพิ่มผู้ใช้หลายคนใน transaction เดียว ข้ามคนที่มีอยู่แล้ว คืนค่าจำนวนที่เพิ่มได้"""
+    conn = get_db()
+    # rowcount ของ executemany รวมทุกแถวแต่ไม่นับแถวที่ trigger แก้ (ต่างจาก total_changes)
+    with conn:
+        added = conn.executemany('INSERT OR IGNORE INTO users (user_id, name) VALUES (?, ?)', users).rowcount
+    if added:
+        _invalidate_users()
+    return added
+
+def export_users():
+    """คืนค่าผู้ใช้ทั้งหมดสำหรับ export [(user_id, name), ...]"""
+    return list(get_all_users())
+
+def record_samples(samples):
+    """บันทึก sample หลายรายการใน transaction เดียว และใส่ id ของแถวกลับลงใน sample แต่ละตัว"""
+    if not samples:
+        return
+    conn = get_db()
+    with conn:
+        for sample in samples:
+            levels = (list(sample["levels"]) + [None] * 4)[:4]
+            cursor = conn.execute(
+                'INSERT INTO samples (ts, printer, m, c, y, bk, status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sample["ts"], sample["printer"], *levels, sample["status"])
+            )
+            sample["id"] = cursor.lastrowid
+
+def get_samples(printer, start=None, end=None, limit=None):
+    """
+    ดึงประวัติระดับหมึกของเครื่องพิมพ์ในช่วงเวลา [start, end) (unix timestamp)
+    คืนค่า [(ts, m, c, y, bk, status), ...] เรียงตามเวลา
+    """
+    query = 'SELECT ts, m, c, y, bk, status FROM samples WHERE printer = ?'
+    params = [printer]
+    if start is not None:
+        query += ' AND ts >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND ts < ?'
+        params.append(end)
+    query += ' ORDER BY ts'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return get_db().execute(query, params).fetchall()
+
+
+# ---- Webhook ingestion ----
+# /webhook ตรวจ signature แล้วโยน event เข้า asyncio queue และตอบกลับทันที
+# worker จะดึง event ออกเป็นชุดแล้วเขียน DB ใน thread แยก (ไม่ block event loop)
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_BATCH_WAIT = float(os.getenv("WEBHOOK_BATCH_WAIT", "0.2"))
+
+_event_queue = None
+# ใช้ thread เดียวสำหรับเขียน DB จาก webhook เพื่อไม่ให้แย่ง lock กันเอง
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+def delete_users(user_ids):
+    """ลบผู้ใช้หลายคนใน transaction เดียว คืนค่าจำนวนที่ลบได้"""
+    conn = get_db()
+    with conn:
+        deleted = conn.executemany(
+            'DELETE FROM users WHERE user_id = ?', [(user_id,) for user_id in user_ids]
+        ).rowcount
+    if deleted:
+        _invalidate_users()
     return deleted
 
-init_db()
+def process_events(events):
+    """
+    จัดการ event ชุดหนึ่ง: follow = เพิ่มผู้ใช้, unfollow = ลบผู้ใช้
+    ถ้าผู้ใช้คนเดียวกันมีหลาย event ในชุดเดียว จะใช้ event ล่าสุด
+    """
+    actions = {}
+    for event in events:
+        source = event.get('source', {})
+        if source.get('type') == 'group':
+            print(f"Group ID: {source.get('groupId')}")
+        elif source.get('type') == 'user':
+            user_id = source.get('userId')
+            if event.get('type') in ('follow', 'unfollow'):
+                actions[user_id] = event['type']
+            else:
+                print(f"User ID: {user_id}")
+
+    follows = [(user_id, None) for user_id, action in actions.items() if action == 'follow']
+    unfollows = [user_id for user_id, action in actions.items() if action == 'unfollow']
+    if follows:
+        print(f"Auto-subscribed {import_users(follows)}/{len(follows)} users")
+    if unfollows:
+        print(f"Unsubscribed {delete_users(unfollows)}/{len(unfollows)} users")
+
+async def _event_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        events = [await _event_queue.get()]
+        deadline = loop.time() + WEBHOOK_BATCH_WAIT
+        while len(events) < WEBHOOK_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                events.append(await asyncio.wait_for(_event_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await loop.run_in_executor(_db_executor, process_events, events)
+        except Exception as e:
+            print(f"Error processing {len(events)} webhook events: {e}")
+
+@app.on_event("startup")
+async def start_event_worker():
+    global _event_queue
+    _event_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    app.state.event_worker = asyncio.create_task(_event_worker())
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    body = await request.json()    
-    if body.get('events'):
-        for event in body['events']:
-            source = event.get('source', {})
-            if source.get('type') == 'group':
-                group_id = source.get('groupId')
-                print(f"Group ID: {group_id}")
-            elif source.get('type') == 'user':
-                user_id = source.get('userId')
-                print(f"User ID: {user_id}")
+    body = await request.body()
+    signature = request.headers.get('X-Line-Signature', '')
+    if not verify_signature(body, signature):
+        return JSONResponse({"status": "error", "message": "Invalid signature"}, status_code=400)
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+    events = payload.get('events', []) if isinstance(payload, dict) else None
+    # event ที่ไม่ใช่ object จะทำให้ process_events ล้มทั้งชุด (รวม event ของ request อื่น)
+    if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+        return JSONResponse({"status": "error", "message": "Invalid payload"}, status_code=400)
+    # ใส่ทั้งหมดหรือไม่ใส่เลย ถ้าคิวไม่พอตอบ 503 ให้ LINE ส่ง event ชุดนี้มาใหม่
+    if _event_queue.maxsize and _event_queue.maxsize - _event_queue.qsize() < len(events):
+        increment("webhook_events_dropped", len(events))
+        print(f"Webhook queue full, rejecting {len(events)} events")
+        return JSONResponse({"status": "error", "message": "Webhook queue full"}, status_code=503)
+    for event in events:
+        _event_queue.put_nowait(event)
     
     return 'OK'
 
+# ---- /check และ /status ----
+# งานที่ใช้เวลานาน (scrape + Sheets + LINE) รันใน thread pool ไม่ block event loop
+# ถ้ากดซ้ำระหว่างที่งานเดิมยังไม่เสร็จ จะรอผลของงานเดิมแทนการเริ่มงานใหม่
+# /status อ่านผลล่าสุดที่ scheduler บันทึกไว้อย่างเดียว ไม่ติดต่อเครื่องพิมพ์เอง
+
+_job_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="job")
+_inflight_jobs = {}
+
+async def run_coalesced(key, func):
+    """รัน func ใน thread pool โดยรวมคำขอ key เดียวกันที่เข้ามาซ้อนกันให้เหลือครั้งเดียว"""
+    future = _inflight_jobs.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_job_executor, func)
+        _inflight_jobs[key] = future
+        future.add_done_callback(lambda _: _inflight_jobs.pop(key, None))
+    return await asyncio.shield(future)
+
 @app.get("/check")
 async def check_printers():
     try:
-        job_7am()  # ใช้ job_7am สำหรับทดสอบ (ส่งทั้ง flex และ text)
+        # ใช้ job_7am สำหรับทดสอบ (ส่งทั้ง flex และ text) และไม่ส่งซ้ำถ้า worker อื่นกำลังส่งอยู่
+        await run_coalesced("job_7am", lambda: run_exclusive("job_7am", job_7am))
         return {"status": "success", "message": "ตรวจสอบสถานะเครื่องพิมพ์เรียบร้อยแล้ว"}
     except Exception as e:
         return {"status": "error", "message": f"เกิดข้อผิดพลาด: {str(e)}"}
 
+@app.get("/status")
+async def printer_status():
+    """สถานะล่าสุดของทุกเครื่องพิมพ์จากรอบตรวจสอบล่าสุดของแต่ละเครื่อง (ts บอกเวลาที่ตรวจ)"""
+    return get_status_snapshot()
+
+@app.get("/printers")
+async def list_printers():
+    return {"printers": list(PRINTERS.values())}
+
+@app.get("/history/{printer_name}")
+async def printer_history(printer_name: str, start: int = None, end: int = None, limit: int = 1000):
+    if get_printer(printer_name) is None:
+        return JSONResponse({"status": "error", "message": "ไม่พบเครื่องพิมพ์นี้"}, status_code=404)
+    rows = get_samples(printer_name, start, end, limit)
+    return {
+        "printer": printer_name,
+        "samples": [
+            {"ts": ts, "levels": [m, c, y, bk], "status": status}
+            for ts, m, c, y, bk, status in rows
+        ]
+    }
+
+# ---- Export ----
+# ส่งออกประวัติระดับหมึกเป็น CSV, Parquet หรือ Arrow IPC แบบ streaming
+# อ่าน DB ทีละ EXPORT_CHUNK_SIZE แถวด้วย connection ของตัวเอง (StreamingResponse อาจเรียก
+# generator จากหลาย thread) หน่วยความจำจึงคงที่ไม่ว่าช่วงเวลาจะยาวแค่ไหน
+# Parquet/Arrow ใช้ pyarrow (อยู่ใน requirements.txt) ถ้าไม่ได้ติดตั้งจะตอบ 501
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "10000"))
+EXPORT_COLUMNS = ["printer", "ts", "time", "m", "c", "y", "bk", "status"]
+
+def _parse_export_time(value):
+    """รับ unix timestamp หรือวันที่ YYYY-MM-DD (เวลาไทย) คืนค่า unix timestamp"""
+    if value is None or value == "":
+        return None
+    if value.lstrip("-").isdigit():
+        return int(value)
+    return int(tz.localize(datetime.strptime(value, "%Y-%m-%d")).timestamp())
+
+def iter_sample_chunks(printers, start=None, end=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    คืนค่า sample ของเครื่องพิมพ์ตามลำดับ printers ทีละไม่เกิน chunk_size แถว
+    แต่ละแถวเป็น (printer, ts, m, c, y, bk, status)
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    try:
+        for printer in printers:
+            query = 'SELECT printer, ts, m, c, y, bk, status FROM samples WHERE printer = ?'
+            params = [printer]
+            if start is not None:
+                query += ' AND ts >= ?'
+                params.append(start)
+            if end is not None:
+                query += ' AND ts < ?'
+                params.append(end)
+            cursor = conn.execute(query + ' ORDER BY ts', params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        conn.close()
+
+def _tz_offset(ts):
+    return int(datetime.fromtimestamp(ts, tz).utcoffset().total_seconds())
+
+@functools.lru_cache(maxsize=4096)
+def _day_utc_offset(day):
+    """offset ของ tz ทั้งวัน (None ถ้าวันนั้นเปลี่ยน offset) datetime ของ pytz ช้าเกินไปเมื่อทำทุกแถว"""
+    offset = _tz_offset(day * 86400)
+    return offset if offset == _tz_offset(day * 86400 + 86399) else None
+
+def _export_time(ts):
+    offset = _day_utc_offset(ts // 86400)
+    if offset is None:
+        offset = _tz_offset(ts)
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts + offset))
+
+def stream_samples_csv(chunks):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(
+            (printer, ts, _export_time(ts), m, c, y, bk, status)
+            for printer, ts, m, c, y, bk, status in rows
+        )
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+    if output.tell():
+        yield output.getvalue()
+
+class _StreamSink:
+    """file-like สำหรับ pyarrow ที่เก็บข้อมูลไว้ให้ generator ส่งออกทีละส่วน (tell() ยังนับต่อเนื่อง)"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def _arrow_schema(pa):
+    return pa.schema([
+        ("printer", pa.string()),
+        ("ts", pa.int64()),
+        ("time", pa.timestamp("s", tz=str(tz))),
+        ("m", pa.int32()),
+        ("c", pa.int32()),
+        ("y", pa.int32()),
+        ("bk", pa.int32()),
+        ("status", pa.string()),
+    ])
+
+def _arrow_batch(pa, schema, rows):
+    columns = list(zip(*rows))
+    printer, ts, m, c, y, bk, status = columns
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(printer, pa.string()),
+            pa.array(ts, pa.int64()),
+            pa.array(ts, pa.int64()).cast(pa.timestamp("s", tz=str(tz))),
+            pa.array(m, pa.int32()),
+            pa.array(c, pa.int32()),
+            pa.array(y, pa.int32()),
+            pa.array(bk, pa.int32()),
+            pa.array(status, pa.string()),
+        ],
+        schema=schema
+    )
+
+def stream_samples_arrow(chunks, file_format):
+    """file_format = "parquet" (row group ละหนึ่ง chunk) หรือ "arrow" (Arrow IPC stream)"""
+    import pyarrow as pa
+    schema = _arrow_schema(pa)
+    sink = _StreamSink()
+    if file_format == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+        write = writer.write_batch
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+        write = writer.write_batch
+    try:
+        for rows in chunks:
+            write(_arrow_batch(pa, schema, rows))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+EXPORT_FORMATS = {
+    # format -> (media type, นามสกุลไฟล์, ต้องใช้ pyarrow)
+    "csv": ("text/csv", "csv", False),
+    "parquet": ("application/vnd.apache.parquet", "parquet", True),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows", True),
+}
+
+@app.get("/export/{file_format}")
+async def export_samples(
+    file_format: str,
+    printer: list[str] = Query(None),
+    start: str = None,
+    end: str = None,
+):
+    """
+    ส่งออกประวัติระดับหมึก เช่น /export/csv?printer=Printer_1&start=2024-01-01&end=2025-01-01
+    ไม่ระบุ printer = ทุกเครื่อง, start/end เป็น unix timestamp หรือ YYYY-MM-DD ([start, end))
+    """
+    if file_format not in EXPORT_FORMATS:
+        return JSONResponse({"status": "error", "message": "รองรับเฉพาะ csv, parquet, arrow"}, status_code=404)
+    media_type, extension, needs_arrow = EXPORT_FORMATS[file_format]
+
+    names = printer or list(PRINTERS)
+    unknown = [name for name in names if get_printer(name) is None]
+    if unknown:
+        return JSONResponse({"status": "error", "message": f"ไม่พบเครื่องพิมพ์: {', '.join(unknown)}"}, status_code=404)
+    try:
+        start_ts, end_ts = _parse_export_time(start), _parse_export_time(end)
+    except ValueError:
+        return JSONResponse({"status": "error", "message": "start/end ต้องเป็น unix timestamp หรือ YYYY-MM-DD"}, status_code=400)
+
+    if needs_arrow:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return JSONResponse(
+                {"status": "error", "message": f"ต้องติดตั้ง pyarrow เพื่อส่งออกเป็น {file_format}"},
+                status_code=501
+            )
+
+    chunks = iter_sample_chunks(names, start_ts, end_ts)
+    body = stream_samples_csv(chunks) if file_format == "csv" else stream_samples_arrow(chunks, file_format)
+    filename = f"samples_{start or 'all'}_{end or 'now'}.{extension}"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+@app.get("/forecast")
+async def forecast_all():
+    # ครั้งแรกต้องโหลดประวัติย้อนหลังจาก DB จึงทำใน thread pool ไม่ block event loop
+    loop = asyncio.get_running_loop()
+    forecast = await loop.run_in_executor(None, lambda: {name: get_forecast(name) for name in PRINTERS})
+    return {"forecast": forecast}
+
+@app.get("/forecast/{printer_name}")
+async def forecast_printer(printer_name: str):
+    if get_printer(printer_name) is None:
+        return JSONResponse({"status": "error", "message": "ไม่พบเครื่องพิมพ์นี้"}, status_code=404)
+    forecast = await asyncio.get_running_loop().run_in_executor(None, get_forecast, printer_name)
+    return {"printer": printer_name, "forecast": forecast}
+
+USERS_PAGE_SIZE = 50
+
+@app.get("/states")
+async def printer_states():
+    return {"states": get_printer_states()}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    return {"startup": get_startup_timings(), "stages": get_stats(), "counters": get_counters()}
+
 @app.get("/users", response_class=HTMLResponse)
-async def users_page():
-    users = get_all_users()
+async def users_page(page: int = 1):
+    total_users = count_users()
+    total_pages = max(1, (total_users + USERS_PAGE_SIZE - 1) // USERS_PAGE_SIZE)
+    page = min(max(page, 1), total_pages)
+    users = get_users_page(page, USERS_PAGE_SIZE)
     
     html_content = f"""
     <!DOCTYPE html>
@@ -168,7 +1059,7 @@ async def users_page():
                 
                 <!-- Users List -->
                 <div>
-                    <h2 class="text-lg font-semibold text-gray-800 mb-4">รายการผู้ใช้ทั้งหมด ({len(users)} คน)</h2>
+                    <h2 class="text-lg font-semibold text-gray-800 mb-4">รายการผู้ใช้ทั้งหมด ({total_users} คน)</h2>
                     {"<div class='bg-gray-100 rounded-lg p-4 text-gray-600'>ยังไม่มีผู้ใช้</div>" if not users else ""}
                     {"".join([f'''
                     <div class="bg-white border border-gray-200 rounded-lg p-4 mb-3 flex justify-between items-center">
@@ -186,6 +1077,23 @@ async def users_page():
                         </form>
                     </div>
                     ''' for user in users])}
+                    <div class="flex justify-between items-center mt-4 text-sm text-gray-600">
+                        <div>{f'<a href="/users?page={page - 1}" class="text-blue-600 hover:underline">« ก่อนหน้า</a>' if page > 1 else ""}</div>
+                        <div>หน้า {page} / {total_pages}</div>
+                        <div>{f'<a href="/users?page={page + 1}" class="text-blue-600 hover:underline">ถัดไป »</a>' if page < total_pages else ""}</div>
+                    </div>
+                </div>
+                
+                <!-- Import / Export -->
+                <div class="mt-6 pt-4 border-t border-gray-200 flex flex-wrap gap-4 items-center">
+                    <a href="/users/export" class="text-blue-600 hover:underline">ดาวน์โหลดรายชื่อ (CSV)</a>
+                    <form method="POST" action="/users/import" enctype="multipart/form-data" class="flex gap-2 items-center">
+                        <input type="file" name="file" accept=".csv" required class="text-sm">
+                        <button type="submit"
+                                class="bg-blue-600 hover:bg-blue-700 text-white text-sm px-3 py-1 rounded transition duration-200">
+                            นำเข้า CSV
+                        </button>
+                    </form>
                 </div>
                 
                 <!-- Test Button -->
@@ -224,6 +1132,31 @@ async def add_user_endpoint(user_id: str = Form(...), name: str = Form(None)):
             status_code=400
         )
 
+@app.get("/users/export")
+async def export_users_endpoint():
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["user_id", "name"])
+    writer.writerows(export_users())
+    return Response(
+        output.getvalue(),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=users.csv"}
+    )
+
+@app.post("/users/import")
+async def import_users_endpoint(file: UploadFile = File(...)):
+    """นำเข้าผู้ใช้จากไฟล์ CSV (คอลัมน์ user_id, name เหมือนไฟล์ที่ export)"""
+    content = (await file.read()).decode("utf-8-sig")
+    users = [
+        (row["user_id"].strip(), (row.get("name") or "").strip() or None)
+        for row in csv.DictReader(io.StringIO(content))
+        if (row.get("user_id") or "").strip()
+    ]
+    added = import_users(users)
+    print(f"Imported {added}/{len(users)} users")
+    return RedirectResponse(url="/users", status_code=303)
+
 @app.post("/users/delete")
 async def delete_user_endpoint(user_id: str = Form(...)):
     if delete_user(user_id):
@@ -234,23 +1167,25 @@ async def delete_user_endpoint(user_id: str = Form(...)):
             status_code=404
         )
 
-def create_printer_bubble(printer_name, ink_levels):
-    """
-    สร้าง bubble สำหรับเครื่องพิมพ์
-    ink_levels = [M, C, Y, BK] ตามลำดับ
-    """
-    colors = ["M", "C", "Y", "BK"]
-    color_configs = {
-        "M": {"backgroundColor": "#ff00ff", "borderColor": "#ff00ff"},
-        "C": {"backgroundColor": "#00FFFF", "borderColor": "#00FFFF"}, 
-        "Y": {"backgroundColor": "#FFFF00", "borderColor": "#FFFF00"},
-        "BK": {"backgroundColor": "#000000", "borderColor": "#000000"}
-    }
-    
+# ---- Flex templates ----
+# โครง bubble ถูกสร้างครั้งเดียวตอน import แล้วแต่ละครั้งแค่เปลี่ยนชื่อ lab/เครื่องพิมพ์และระดับหมึก
+# ส่วนที่ไม่เปลี่ยนถูกใช้ร่วมกันทุก bubble ห้ามแก้ dict ที่ได้จาก create_printer_bubble โดยตรง
+FLEX_CAROUSEL_MAX = 12   # LINE รับ bubble ได้ไม่เกิน 12 อันต่อ carousel
+FLEX_CACHE_SIZE = int(os.getenv("FLEX_CACHE_SIZE", "256"))
+
+_FLEX_COLOR_CONFIGS = {
+    "M": {"backgroundColor": "#ff00ff", "borderColor": "#ff00ff"},
+    "C": {"backgroundColor": "#00FFFF", "borderColor": "#00FFFF"},
+    "Y": {"backgroundColor": "#FFFF00", "borderColor": "#FFFF00"},
+    "BK": {"backgroundColor": "#000000", "borderColor": "#000000"}
+}
+
+def _build_bubble_template():
+    """สร้างโครง bubble ที่ยังไม่มีชื่อและระดับหมึก (เรียกครั้งเดียว)"""
     contents = []
-    for i, color in enumerate(colors):
-        color_config = color_configs[color]
-        content = {
+    for color in ["M", "C", "Y", "BK"]:
+        color_config = _FLEX_COLOR_CONFIGS[color]
+        contents.append({
             "type": "box",
             "layout": "horizontal",
             "contents": [
@@ -280,14 +1215,13 @@ def create_printer_bubble(printer_name, ink_levels):
                 },
                 {
                     "type": "text",
-                    "text": str(ink_levels[i])
+                    "text": ""
                 }
             ],
             "spacing": "lg"
-        }
-        contents.append(content)
-    
-    bubble = {
+        })
+
+    return {
         "type": "bubble",
         "header": {
             "type": "box",
@@ -295,12 +1229,12 @@ def create_printer_bubble(printer_name, ink_levels):
             "contents": [
                 {
                     "type": "text",
-                    "text": "LAB2",
+                    "text": "",
                     "color": "#ffffff66"
                 },
                 {
                     "type": "text",
-                    "text": printer_name,
+                    "text": "",
                     "color": "#FFFFFF",
                     "size": "xl",
                     "weight": "bold"
@@ -315,179 +1249,1666 @@ def create_printer_bubble(printer_name, ink_levels):
             "contents": contents
         }
     }
-    return bubble
 
-def send_text_message(message_text):
-    """ส่ง text message ปกติให้ทุก userId ในฐานข้อมูล"""
+_BUBBLE_TEMPLATE = _build_bubble_template()
+
+def create_printer_bubble(printer_name, ink_levels, lab=LAB_NAME):
+    """
+    สร้าง bubble สำหรับเครื่องพิมพ์จากโครงที่สร้างไว้แล้ว
+    ink_levels = [M, C, Y, BK] ตามลำดับ
+    """
+    header = _BUBBLE_TEMPLATE["header"]
+    lab_text, name_text = header["contents"]
+    body = _BUBBLE_TEMPLATE["body"]
+
+    rows = []
+    for row, level in zip(body["contents"], ink_levels):
+        label, dot, value = row["contents"]
+        rows.append({**row, "contents": [label, dot, {**value, "text": str(level)}]})
+
+    return {
+        **_BUBBLE_TEMPLATE,
+        "header": {**header, "contents": [{**lab_text, "text": lab}, {**name_text, "text": printer_name}]},
+        "body": {**body, "contents": rows}
+    }
+
+@functools.lru_cache(maxsize=FLEX_CACHE_SIZE)
+def build_flex_message(page):
+    """
+    สร้าง FlexMessage (ผ่าน validation แล้ว) จาก page = ((lab, printer_name, (M, C, Y, BK)), ...)
+    ผลลัพธ์ถูก cache ไว้ สถานะเดิมจึงได้ object เดิมโดยไม่ต้องสร้างใหม่
+    """
+    from linebot.v3.messaging import FlexMessage, FlexContainer
+    bubbles = [create_printer_bubble(name, levels, lab) for lab, name, levels in page]
+    if len(bubbles) == 1:
+        flex_content = bubbles[0]
+    else:
+        flex_content = {
+            "type": "carousel",
+            "contents": bubbles
+        }
+    return FlexMessage(
+        alt_text="Printer Status",
+        contents=FlexContainer.from_dict(flex_content)
+    )
+
+def build_flex_messages(printer_data):
+    """แบ่งเครื่องพิมพ์เป็นหน้า ๆ ละไม่เกิน FLEX_CAROUSEL_MAX bubble แล้วคืนค่า FlexMessage ต่อหน้า"""
+    entries = [
+        (printer["lab"], printer["name"], tuple(ink_levels))
+        for printer, ink_levels in printer_data
+        if ink_levels
+    ]
+    return [
+        build_flex_message(tuple(entries[i:i + FLEX_CAROUSEL_MAX]))
+        for i in range(0, len(entries), FLEX_CAROUSEL_MAX)
+    ]
+
+# ---- LINE delivery ----
+# ส่งข้อความแบบ multicast ทีละไม่เกิน 500 userId ต่อ request (ข้อจำกัดของ LINE)
+# ใช้ ApiClient ตัวเดียวร่วมกันทุก thread ข้อความถูกใส่ลง outbox แล้ว outbox worker ส่งหลาย batch พร้อมกัน
+LINE_MULTICAST_SIZE = 500
+LINE_MAX_MESSAGES = 5    # จำนวน message สูงสุดต่อ request
+LINE_RETRY_BACKOFF = float(os.getenv("LINE_RETRY_BACKOFF", "1"))
+
+_line_api = None
+_line_api_lock = threading.Lock()
+
+def get_line_api():
+    """คืนค่า MessagingApi ที่ใช้ connection pool ร่วมกัน (สร้างครั้งเดียว)"""
+    global _line_api
+    with _line_api_lock:
+        if _line_api is None:
+            from linebot.v3.messaging import ApiClient, MessagingApi
+            configuration = get_line_configuration()
+            configuration.connection_pool_maxsize = max(
+                configuration.connection_pool_maxsize, OUTBOX_WORKERS
+            )
+            _line_api = MessagingApi(ApiClient(configuration))
+        return _line_api
+
+def _is_retryable(e):
+    return e.status == 429 or (e.status is not None and e.status >= 500)
+
+def _retry_delay(e, attempt):
+    """ใช้ Retry-After จาก LINE ถ้ามี ไม่งั้น backoff แบบ exponential"""
+    headers = dict(e.headers or {})
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return LINE_RETRY_BACKOFF * (2 ** attempt)
+
+@functools.lru_cache(maxsize=FLEX_CACHE_SIZE)
+def _outbox_messages(messages_json):
+    """
+    แปลง message ที่เก็บใน outbox (JSON) กลับเป็น Message ของ LINE SDK
+    validate ครั้งเดียวต่อเนื้อหา ทุก batch ของการส่งเดียวกันจึงใช้ object ชุดเดียวกัน
+    """
+    from linebot.v3.messaging import Message
+    return [Message.from_dict(message) for message in json.loads(messages_json)]
+
+@timed("line_multicast")
+def _send_multicast(user_ids, messages, retry_key):
+    """
+    ส่ง multicast หนึ่ง batch (ครั้งเดียว การลองใหม่เป็นหน้าที่ของ outbox) คืนค่าจำนวนผู้รับ
+    messages เป็น dict ของ message ที่เก็บไว้ใน outbox
+    """
+    from linebot.v3.messaging import MulticastRequest, ApiException
+    # message ผ่านการ validate แล้วใน _outbox_messages จึงใช้ construct (ไม่ validate ซ้ำทุก batch)
+    request = MulticastRequest.construct(
+        to=user_ids,
+        messages=_outbox_messages(json.dumps(messages, ensure_ascii=False, sort_keys=True))
+    )
+    try:
+        get_line_api().multicast(request, x_line_retry_key=retry_key)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        # retry key นี้ถูกส่งสำเร็จไปแล้ว
+    return len(user_ids)
+
+def broadcast_messages(messages, label="Message", key=None):
+    """
+    ใส่ messages (สร้างไว้แล้วครั้งเดียว) ลง outbox เพื่อส่งให้ทุก userId ในฐานข้อมูล
+    key = idempotency key ของการส่งครั้งนี้ (ไม่ระบุ = ส่งใหม่ทุกครั้ง)
+    คืนค่าต่อ batch: [{"batch": i, "total": n, "queued": bool}, ...] (queued=False คือเคยใส่ไว้แล้ว)
+    ผลการส่งจริงของแต่ละ batch ดูได้ที่ /outbox (broadcasts) และ counter line_recipients_* ใน /metrics
+    """
     users = get_all_users()
     if not users:
         print("ไม่มีผู้ใช้ในฐานข้อมูล")
+        return []
+
+    key = key or uuid.uuid4().hex
+    user_ids = [user_id for user_id, name in users]
+    payload_messages = [message.to_dict() for message in messages]
+    items = []
+    for i in range(0, len(user_ids), LINE_MULTICAST_SIZE):
+        batch = i // LINE_MULTICAST_SIZE
+        items.append(("line_multicast", f"line:{key}:{batch}", {
+            "batch": batch,
+            "label": label,
+            "to": user_ids[i:i + LINE_MULTICAST_SIZE],
+            "messages": payload_messages,
+        }))
+    queued = enqueue_outbox(items)
+
+    print(f"{label} queued for {len(user_ids)} users in {len(items)} batches")
+    return [
+        {"batch": payload["batch"], "total": len(payload["to"]), "queued": inserted}
+        for (kind, idem_key, payload), inserted in zip(items, queued)
+    ]
+
+@timed("send_text_message")
+def send_text_message(message_text, key=None):
+    """ส่ง text message ปกติให้ทุก userId ในฐานข้อมูล (key ดูที่ broadcast_messages)"""
+    print(f"Text message: {message_text}")
+    from linebot.v3.messaging import TextMessage
+    return broadcast_messages([TextMessage(text=message_text)], label="Text message", key=key)
+
+@timed("handle_flex_message")
+def handle_flex_message(printer_data, extra_messages=None):
+    """
+    ส่ง flex message สถานะหมึกให้ทุก userId
+    printer_data = [(printer, ink_levels), ...] เรียงตามทะเบียนเครื่องพิมพ์
+    extra_messages = message เพิ่มเติมที่จะส่งต่อท้าย flex message
+    """
+    try:
+        flex_messages = build_flex_messages(printer_data)
+    except Exception as e:
+        print(f"Error preparing flex message: {e}")
         return
-    
-    success_count = 0
-    for user_id, name in users:
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(text=message_text)]
-                    )
-                )
-            success_count += 1
-            print(f"Text message sent to {name or user_id}: {message_text}")
-        except Exception as e:
-            print(f"Error sending text message to {name or user_id}: {e}")
-    
-    print(f"Text message sent successfully to {success_count}/{len(users)} users")
 
-def handle_flex_message(printer_1_data, printer_2_data):
-    users = get_all_users()
-    if not users:
-        print("ไม่มีผู้ใช้ในฐานข้อมูล")
+    if not flex_messages:
+        print("No printer data to send")
         return
-    
+
+    # LINE รับได้ไม่เกิน LINE_MAX_MESSAGES message ต่อ request ถ้าเกินจะส่งเป็นหลายรอบตามลำดับ
+    messages = flex_messages + (extra_messages or [])
+    results = []
+    for i in range(0, len(messages), LINE_MAX_MESSAGES):
+        results.extend(broadcast_messages(messages[i:i + LINE_MAX_MESSAGES], label="Flex message"))
+    return results
+
+
+# ---- Google Sheets writer ----
+# แต่ละ row ถูกใส่ลง outbox แล้ว outbox worker เขียนด้วย append_rows ครั้งเดียวต่อ worksheet
+# (ดู "Outbox" ด้านล่าง) การตรวจสอบเครื่องพิมพ์จึงไม่ต้องรอ Google Sheets
+# row ของ worksheet หนึ่งจะรอจนครบ SHEET_BATCH_SIZE แถว หรือแถวแรกค้างนานเกิน SHEET_FLUSH_SECONDS วินาที
+# spill file ของเวอร์ชันก่อนจะถูกย้ายเข้า outbox ตอนเริ่มทำงาน
+SHEET_BATCH_SIZE = int(os.getenv("SHEET_BATCH_SIZE", "50"))
+SHEET_FLUSH_SECONDS = float(os.getenv("SHEET_FLUSH_SECONDS", "60"))
+SHEET_SPILL_PATH = os.getenv(
+    "SHEET_SPILL_PATH",
+    os.path.join(os.path.dirname(DB_PATH) or ".", "sheet_spill.jsonl")
+)
+
+_spreadsheet = None
+_spreadsheet_client = None  # client ที่ใช้เปิด _spreadsheet และ _worksheets
+_worksheets = {}
+_worksheet_lock = threading.Lock()
+
+def get_worksheet(sheet_name):
+    """
+    คืนค่า worksheet ที่เปิดไว้แล้ว (เปิด spreadsheet เพียงครั้งเดียวต่อ client)
+    เมื่อ client ถูกสร้างใหม่ (ครบ SHEET_CLIENT_TTL หรือหลัง error) จะเปิด handle ใหม่จาก client นั้น
+    """
+    global _spreadsheet, _spreadsheet_client
+    client = get_sheet_client()
+    with _worksheet_lock:
+        if client is not _spreadsheet_client:
+            _spreadsheet = None
+            _worksheets.clear()
+            _spreadsheet_client = client
+        worksheet = _worksheets.get(sheet_name)
+        if worksheet is not None:
+            return worksheet
+        if _spreadsheet is None:
+            _spreadsheet = client.open_by_url(sheet_url)
+        spreadsheet = _spreadsheet
+    # เปิดนอก lock เพื่อให้ outbox worker เปิดหลาย worksheet พร้อมกันได้
+    worksheet = spreadsheet.worksheet(sheet_name)
+    with _worksheet_lock:
+        if _spreadsheet_client is not client:
+            return worksheet  # client ถูกเปลี่ยนระหว่างเปิด ไม่เก็บ handle ของ client เก่า
+        return _worksheets.setdefault(sheet_name, worksheet)
+
+def _reset_worksheets():
+    """ล้าง handle ที่ cache ไว้ เผื่อ handle เดิมใช้ไม่ได้แล้ว"""
+    global _spreadsheet, _spreadsheet_client
+    with _worksheet_lock:
+        _spreadsheet = None
+        _spreadsheet_client = None
+        _worksheets.clear()
+
+def _import_spill_file():
+    """ย้าย row ที่ค้างใน spill file (จากเวอร์ชันก่อน) เข้า outbox แล้วลบไฟล์ทิ้ง"""
+    if not os.path.exists(SHEET_SPILL_PATH):
+        return
+    items = []
+    with open(SHEET_SPILL_PATH, encoding="utf-8") as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue  # บรรทัดสุดท้ายอาจเขียนไม่ครบตอนเครื่องดับ
+            items.append(("sheet_row", f"sheet:spill:{uuid.uuid4().hex}", {"sheet": item["sheet"], "row": item["row"]}))
+    enqueue_outbox(items)
+    os.remove(SHEET_SPILL_PATH)
+    if items:
+        print(f"Moved {len(items)} pending sheet rows from {SHEET_SPILL_PATH} to outbox")
+
+def _deliver_sheet_rows(items):
+    """เขียน row ของ worksheet เดียวกันทั้งหมดด้วย append_rows ครั้งเดียว"""
+    sheet_name = items[0]["payload"]["sheet"]
+    rows = [item["payload"]["row"] for item in items]
+    started = time.perf_counter()
     try:
-        bubbles = []
-        
-        # เพิ่ม bubble สำหรับ printer 1
-        if printer_1_data:
-            bubble1 = create_printer_bubble("Printer_1", printer_1_data)
-            bubbles.append(bubble1)
-        
-        # เพิ่ม bubble สำหรับ printer 2
-        if printer_2_data:
-            bubble2 = create_printer_bubble("Printer_2", printer_2_data)
-            bubbles.append(bubble2)
-        
-        if not bubbles:
-            print("No printer data to send")
+        get_worksheet(sheet_name).append_rows(rows, value_input_option="USER_ENTERED")
+    except Exception as e:
+        observe("sheet_append_rows", time.perf_counter() - started, error=True)
+        print(f"Error writing {len(rows)} rows to sheet {sheet_name}: {e}")
+        _reset_worksheets()
+        _reset_sheet_client()
+        return {item["id"]: e for item in items}
+    observe("sheet_append_rows", time.perf_counter() - started)
+    return {item["id"]: None for item in items}
+
+def sample_to_row(sample):
+    """
+    แปลง sample เป็น row ของ Google Sheets (รูปแบบเดิม: เวลา, ระดับหมึก..., สถานะ)
+    ระดับหมึกที่อ่านไม่ได้ (None) เขียนเป็น 0 เหมือน Sheet เดิม
+    """
+    timestamp = datetime.fromtimestamp(sample["ts"], tz).strftime("%m/%d/%Y %H:%M:00")
+    levels = [0 if level is None else level for level in sample["levels"]]
+    return [timestamp, *levels, sample["status"]]
+
+def export_samples_to_sheet(samples):
+    """ใส่ sample ที่บันทึกแล้วลง outbox เพื่อเขียนต่อไปยัง worksheet ของแต่ละเครื่องพิมพ์"""
+    items = []
+    for sample in samples:
+        printer = get_printer(sample["printer"])
+        if printer is not None:
+            # ใช้ id ของแถวใน samples เป็น key (ts ละเอียดแค่วินาที poll สองรอบในวินาทีเดียวกันจะชนกัน)
+            # ถ้าบันทึกลง DB ไม่สำเร็จจะไม่มี id ก็ใช้ uuid แทน
+            sample_id = sample.get("id")
+            key = f"sheet:sample:{sample_id}" if sample_id is not None else f"sheet:{uuid.uuid4().hex}"
+            items.append((
+                "sheet_row", key,
+                {"sheet": printer["worksheet"], "row": sample_to_row(sample)}
+            ))
+    enqueue_outbox(items)
+
+# ---- Outbox ----
+# worker (เฉพาะ leader ของ outbox.lock) ดึงงานที่ถึงเวลาจากตาราง outbox แล้วส่งพร้อมกันใน thread pool
+#   sheet_row      = รวม row ของ worksheet เดียวกันเป็น append_rows ครั้งเดียว เมื่อครบ SHEET_BATCH_SIZE แถว
+#                    หรือแถวแรกค้างนานเกิน SHEET_FLUSH_SECONDS ถ้าเขียนไม่สำเร็จ row ใหม่ของ worksheet นั้น
+#                    จะรอจน row เดิมเขียนได้ก่อน ลำดับใน sheet จึงไม่สลับ
+#   line_multicast = ส่งตามลำดับภายใน batch ผู้รับเดียวกัน (ข้อความไม่สลับลำดับ) ถ้ารายการใดต้องรอลองใหม่
+#                    รายการหลังจากนั้นของ batch เดียวกันจะรอจนรายการนั้นสำเร็จหรือเป็น dead
+#                    retry key ของ LINE สร้างจาก idem_key จึงไม่ส่งซ้ำแม้ลองใหม่หลัง restart
+# ส่งไม่สำเร็จจะลองใหม่แบบ exponential backoff ครบ OUTBOX_MAX_ATTEMPTS ครั้งจะย้ายเป็น dead
+# (ดูได้ที่ /outbox และส่งใหม่ได้ด้วย POST /outbox/retry)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "5"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "3600"))
+OUTBOX_KEEP_DONE = 7 * 86400  # ลบงานที่ส่งสำเร็จแล้วเมื่อเก่ากว่านี้
+
+_outbox_executor = ThreadPoolExecutor(max_workers=OUTBOX_WORKERS, thread_name_prefix="outbox")
+_outbox_wakeup = threading.Event()
+_outbox_drain_lock = threading.Lock()
+_outbox_thread = None
+_outbox_thread_lock = threading.Lock()
+
+def _deliver_line_multicasts(items):
+    """ส่งทีละรายการตามลำดับ ถ้ารายการใดล้มเหลว รายการที่ตามมาจะรอรอบถัดไป"""
+    results = {}
+    for item in items:
+        payload = item["payload"]
+        retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, item["idem_key"]))
+        try:
+            _send_multicast(payload["to"], payload["messages"], retry_key)
+            results[item["id"]] = None
+        except Exception as e:
+            print(f"Error sending {payload['label'].lower()} batch {payload['batch']} ({len(payload['to'])} users): {e}")
+            results[item["id"]] = e
+            break
+    return results
+
+# kind -> (group key ของ payload, ฟังก์ชันส่งทั้งกลุ่ม คืนค่า {id: exception หรือ None}, ต้องส่งตามลำดับ,
+#          จำนวนรายการขั้นต่ำก่อนส่งทั้งกลุ่ม, วินาทีที่รายการแรกรอได้นานสุดก่อนส่งแม้ยังไม่ครบ)
+OUTBOX_KINDS = {
+    "sheet_row": (lambda payload: payload["sheet"], _deliver_sheet_rows, True, SHEET_BATCH_SIZE, SHEET_FLUSH_SECONDS),
+    "line_multicast": (lambda payload: payload["batch"], _deliver_line_multicasts, True, 1, 0),
+}
+
+def enqueue_outbox(items):
+    """
+    ใส่งาน [(kind, idem_key, payload), ...] ลง outbox ใน transaction เดียว
+    งานที่ idem_key ซ้ำจะถูกข้าม คืนค่า [True/False ว่าใส่ใหม่หรือไม่] ตามลำดับ
+    """
+    if not items:
+        return []
+    now = time.time()
+    conn = get_db()
+    inserted = []
+    with conn:
+        for kind, idem_key, payload in items:
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO outbox (kind, idem_key, payload, group_key, next_attempt_at, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (kind, idem_key, json.dumps(payload, ensure_ascii=False),
+                 str(OUTBOX_KINDS[kind][0](payload)), now, now, now)
+            )
+            inserted.append(cursor.rowcount == 1)
+    _outbox_wakeup.set()
+    return inserted
+
+def _outbox_retry_delay(e, attempts):
+    if getattr(e, "status", None) is not None and getattr(e, "headers", None) is not None:
+        return min(OUTBOX_MAX_BACKOFF, _retry_delay(e, attempts))  # LINE ApiException (ใช้ Retry-After ถ้ามี)
+    delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BACKOFF * (2 ** attempts))
+    return delay * random.uniform(0.8, 1.2)
+
+def _outbox_is_permanent(e):
+    """error ของ LINE ที่ลองใหม่ก็ไม่สำเร็จ (เช่น 400 message ไม่ถูกต้อง)"""
+    return getattr(e, "status", None) is not None and not _is_retryable(e)
+
+def _count_outbox_result(kind, item, status):
+    """นับงานที่ส่งสำเร็จ (done) หรือเลิกส่ง (dead) และจำนวนผู้รับ LINE ของ batch นั้น"""
+    increment(f"outbox_{kind}_{status}")
+    if kind == "line_multicast":
+        outcome = "delivered" if status == "done" else "failed"
+        increment(f"line_recipients_{outcome}", len(item["payload"]["to"]))
+
+def drain_outbox(flush=False):
+    """
+    ส่งงานที่ถึงเวลาใน outbox หนึ่งรอบ (สูงสุด OUTBOX_BATCH_SIZE รายการ)
+    flush=True ส่งทุกกลุ่มที่ถึงเวลาโดยไม่รอให้ครบจำนวนขั้นต่ำของ kind นั้น
+    คืนค่าจำนวนงานที่พยายามส่งในรอบนี้
+    """
+    ordered = [kind for kind, (_, _, in_order, _, _) in OUTBOX_KINDS.items() if in_order]
+    batched = [] if flush else [
+        (kind, min_items, max_wait)
+        for kind, (_, _, _, min_items, max_wait) in OUTBOX_KINDS.items() if min_items > 1
+    ]
+    with _outbox_drain_lock:
+        now = time.time()
+        conn = get_db()
+        # ตัดรายการที่ต้องรอรายการก่อนหน้าในกลุ่มเดียวกัน (kind ที่ส่งตามลำดับ) ออกตั้งแต่ใน query
+        # LIMIT จึงนับเฉพาะงานที่ส่งได้จริง กลุ่มที่ค้างอยู่ไม่บังงานอื่น
+        query = (
+            "SELECT id, kind, idem_key, payload, attempts, group_key FROM outbox AS o "
+            "WHERE status = 'pending' AND next_attempt_at <= ? "
+            f"AND NOT (kind IN ({', '.join('?' * len(ordered))}) AND EXISTS ("
+            "    SELECT 1 FROM outbox AS h WHERE h.status = 'pending' AND h.kind = o.kind "
+            "    AND h.group_key = o.group_key AND h.id < o.id AND h.next_attempt_at > ?"
+            "))"
+        )
+        params = [now, *ordered, now]
+        if batched:
+            # กลุ่มของ kind ที่รวมส่งจะส่งเมื่อครบจำนวน, รายการแรกรอนานพอ หรือมีรายการที่ลองใหม่อยู่
+            ready = " OR ".join(
+                "(kind = ? AND group_key IN ("
+                "    SELECT group_key FROM outbox WHERE status = 'pending' AND kind = ? GROUP BY group_key "
+                "    HAVING COUNT(*) >= ? OR MIN(created_at) <= ? OR MAX(attempts) > 0"
+                "))"
+                for _ in batched
+            )
+            query += f" AND (kind NOT IN ({', '.join('?' * len(batched))}) OR {ready})"
+            params += [kind for kind, _, _ in batched]
+            for kind, min_items, max_wait in batched:
+                params += [kind, kind, min_items, now - max_wait]
+        rows = conn.execute(query + " ORDER BY id LIMIT ?", (*params, OUTBOX_BATCH_SIZE)).fetchall()
+        groups = {}
+        for item_id, kind, idem_key, payload, attempts, group_key in rows:
+            if kind not in OUTBOX_KINDS:
+                continue
+            groups.setdefault((kind, group_key), []).append({
+                "id": item_id, "idem_key": idem_key, "payload": json.loads(payload), "attempts": attempts
+            })
+
+        futures = [
+            (kind, items, _outbox_executor.submit(OUTBOX_KINDS[kind][1], items))
+            for (kind, _), items in groups.items()
+        ]
+        done, retry, dead = [], [], []
+        for kind, items, future in futures:
+            try:
+                results = future.result()
+            except Exception as e:
+                results = {item["id"]: e for item in items}
+            next_at = None  # ทั้งกลุ่มลองใหม่พร้อมกัน รายการเก่าจึงถูกส่งรวมกันก่อนรายการใหม่
+            for item in items:
+                if item["id"] not in results:
+                    continue  # ยังไม่ได้ลองในรอบนี้
+                error = results[item["id"]]
+                attempts = item["attempts"] + 1
+                if error is None:
+                    done.append((attempts, time.time(), item["id"]))
+                    _count_outbox_result(kind, item, "done")
+                elif attempts >= OUTBOX_MAX_ATTEMPTS or _outbox_is_permanent(error):
+                    dead.append((attempts, str(error), time.time(), item["id"]))
+                    _count_outbox_result(kind, item, "dead")
+                else:
+                    if next_at is None:
+                        next_at = time.time() + _outbox_retry_delay(error, item["attempts"])
+                    retry.append((attempts, next_at, str(error), time.time(), item["id"]))
+
+        with conn:
+            conn.executemany(
+                "UPDATE outbox SET status = 'done', attempts = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                done
+            )
+            conn.executemany(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                retry
+            )
+            conn.executemany(
+                "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                dead
+            )
+        for attempts, error, _, item_id in dead:
+            print(f"Outbox item {item_id} moved to dead letter after {attempts} attempts: {error}")
+        return len(done) + len(retry) + len(dead)
+
+def purge_outbox():
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "DELETE FROM outbox WHERE status = 'done' AND updated_at < ?",
+            (time.time() - OUTBOX_KEEP_DONE,)
+        )
+
+def _outbox_loop():
+    last_purge = 0.0
+    while True:
+        try:
+            if not drain_outbox():
+                _outbox_wakeup.wait(OUTBOX_POLL_SECONDS)
+                _outbox_wakeup.clear()
+            if time.monotonic() - last_purge > 3600:
+                purge_outbox()
+                last_purge = time.monotonic()
+        except Exception as e:
+            print(f"Error draining outbox: {e}")
+            time.sleep(OUTBOX_POLL_SECONDS)
+
+def start_outbox_worker():
+    """เริ่ม outbox worker (เรียกจาก leader ของ outbox เท่านั้น ไม่ให้หลาย process ส่งงานเดียวกัน)"""
+    global _outbox_thread
+    with _outbox_thread_lock:
+        if _outbox_thread is not None:
             return
-        
-        # สร้าง flex content
-        if len(bubbles) == 1:
-            # ส่ง bubble เดียว
-            flex_content = bubbles[0]
+        _import_spill_file()
+        _outbox_thread = threading.Thread(target=_outbox_loop, name="outbox", daemon=True)
+        _outbox_thread.start()
+
+def get_outbox_counts():
+    """จำนวนงานใน outbox แยกตาม kind และ status"""
+    counts = {}
+    for kind, status, count in get_db().execute(
+        'SELECT kind, status, COUNT(*) FROM outbox GROUP BY kind, status'
+    ):
+        counts.setdefault(kind, {})[status] = count
+    return counts
+
+def get_recent_broadcasts(limit=20):
+    """
+    ผลการส่ง LINE ต่อ batch ของการ broadcast ล่าสุด (ใหม่สุดก่อน)
+    [{"key", "label", "delivered", "pending", "failed", "batches": [...]}, ...] จำนวนเป็นจำนวนผู้รับ
+    """
+    rows = get_db().execute(
+        "SELECT idem_key, status, attempts, last_error, json_extract(payload, '$.label'), "
+        "json_extract(payload, '$.batch'), json_array_length(payload, '$.to') FROM outbox "
+        "WHERE kind = 'line_multicast' ORDER BY id DESC LIMIT ?",
+        (limit * 20,)
+    ).fetchall()
+    broadcasts = {}
+    outcomes = {"done": "delivered", "pending": "pending", "dead": "failed"}
+    for idem_key, status, attempts, last_error, label, batch, total in rows:
+        key = idem_key.rsplit(":", 1)[0]
+        if key not in broadcasts:
+            if len(broadcasts) == limit:
+                break
+            broadcasts[key] = {"key": key, "label": label, "delivered": 0, "pending": 0, "failed": 0, "batches": []}
+        broadcast = broadcasts[key]
+        broadcast[outcomes.get(status, "pending")] += total
+        broadcast["batches"].append({
+            "batch": batch, "total": total, "status": status, "attempts": attempts, "last_error": last_error
+        })
+    for broadcast in broadcasts.values():
+        broadcast["batches"].sort(key=lambda entry: entry["batch"])
+    return list(broadcasts.values())
+
+@app.get("/outbox")
+async def outbox_status():
+    """สรุปงานใน outbox, ผลการส่ง LINE ล่าสุดต่อ batch และงานที่ส่งไม่สำเร็จ (dead letter)"""
+    rows = get_db().execute(
+        "SELECT id, kind, idem_key, attempts, last_error, updated_at FROM outbox "
+        "WHERE status = 'dead' ORDER BY id DESC LIMIT 50"
+    ).fetchall()
+    return {
+        "counts": get_outbox_counts(),
+        "broadcasts": get_recent_broadcasts(),
+        "dead": [
+            {"id": item_id, "kind": kind, "idem_key": idem_key, "attempts": attempts,
+             "last_error": last_error, "updated_at": updated_at}
+            for item_id, kind, idem_key, attempts, last_error, updated_at in rows
+        ],
+    }
+
+@app.post("/outbox/retry")
+async def outbox_retry(item_id: int = Form(None)):
+    """ส่งงานที่เป็น dead ใหม่ (ทั้งหมด หรือเฉพาะ item_id)"""
+    conn = get_db()
+    query = "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = 'dead'"
+    params = [time.time(), time.time()]
+    if item_id is not None:
+        query += " AND id = ?"
+        params.append(item_id)
+    with conn:
+        requeued = conn.execute(query, params).rowcount
+    _outbox_wakeup.set()
+    return {"status": "success", "requeued": requeued}
+
+def _make_sample(printer, ink_levels, status):
+    """ink_levels = None เมื่ออ่านไม่ได้ (บันทึกเป็น NULL ไม่ใช่ 0 ซึ่งจะดูเหมือนหมึกหมด)"""
+    return {
+        "ts": int(time.time()),
+        "printer": printer["name"],
+        "levels": ink_levels if ink_levels is not None else [None] * 4,
+        "status": status,
+    }
+
+# ---- Printer scraper ----
+# profile บอกวิธีอ่านระดับหมึกจากหน้าเว็บของเครื่องพิมพ์แต่ละรุ่น
+#   xpath   = XPath ที่คืนค่าความสูงของแถบหมึก เรียงตาม M, C, Y, BK
+#   max_ink = ความสูงของแถบเมื่อหมึกเต็ม
+#   step    = ปัดเศษระดับหมึก (เปอร์เซ็นต์)
+# เพิ่ม profile ของรุ่นอื่นได้ในไฟล์ SCRAPE_PROFILES_FILE (JSON: {"name": {...}})
+MAX_INK = os.getenv("MAX_INK")
+SCRAPE_PROFILES_FILE = os.getenv("SCRAPE_PROFILES_FILE", "scrape_profiles.json")
+SCRAPE_PROFILES = {
+    "default": {
+        "xpath": "//img[contains(concat(' ', normalize-space(@class), ' '), ' tonerremain ')]/@height",
+        "max_ink": int(MAX_INK) if MAX_INK else None,
+        "step": 10,
+    },
+}
+if os.path.exists(SCRAPE_PROFILES_FILE):
+    with open(SCRAPE_PROFILES_FILE, encoding="utf-8") as f:
+        for profile_name, profile in json.load(f).items():
+            SCRAPE_PROFILES[profile_name] = {**SCRAPE_PROFILES["default"], **profile}
+
+# โหลดทะเบียนเครื่องพิมพ์หลัง SCRAPE_PROFILES เพื่อตรวจชื่อ profile ได้ตั้งแต่เริ่มทำงาน
+PRINTERS = load_printers()
+
+# compile XPath ครั้งเดียวต่อ profile (ตอนใช้งานครั้งแรก)
+_compiled_xpaths = {}
+
+def _get_xpath(profile_name):
+    xpath = _compiled_xpaths.get(profile_name)
+    if xpath is None:
+        from lxml import etree
+        xpath = _compiled_xpaths[profile_name] = etree.XPath(SCRAPE_PROFILES[profile_name]["xpath"])
+    return xpath
+
+_printer_sessions = {}
+_printer_validators = {}  # printer name -> (headers สำหรับ conditional GET, ระดับหมึกล่าสุด)
+_printer_sessions_lock = threading.Lock()
+
+def _get_printer_session(printer):
+    """session แบบ keep-alive แยกต่อเครื่องพิมพ์ ไม่ต้องเปิด TCP ใหม่ทุกครั้ง"""
+    with _printer_sessions_lock:
+        session = _printer_sessions.get(printer["name"])
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _printer_sessions[printer["name"]] = session
+        return session
+
+def parse_ink_levels(content, profile_name="default"):
+    """อ่านระดับหมึก (เปอร์เซ็นต์ ปัดตาม step) จาก HTML ตาม profile"""
+    profile = SCRAPE_PROFILES[profile_name]
+    max_ink = profile["max_ink"]
+    step = profile["step"]
+    ink_levels = []
+    import lxml.html
+    for height in _get_xpath(profile_name)(lxml.html.fromstring(content)):
+        height = str(height).strip()
+        if height.isdigit():
+            percentage = int((int(height) * 100) / max_ink)
+            mapped_value = round(percentage / step) * step
+            mapped_value = max(0, min(100, mapped_value))
+            ink_levels.append(mapped_value)
+    return ink_levels
+
+def scrape_printer(printer, timeout=PRINTER_TIMEOUT):
+    """
+    ดึงหน้าสถานะของเครื่องพิมพ์แล้วคืนค่าระดับหมึก
+    ใช้ ETag/Last-Modified ถ้าเครื่องพิมพ์รองรับ ถ้าหน้าไม่เปลี่ยนจะใช้ค่าเดิมโดยไม่ต้อง parse ใหม่
+    """
+    validators, cached_levels = _printer_validators.get(printer["name"], ({}, None))
+    response = _get_printer_session(printer).get(printer["url"], timeout=timeout, headers=validators)
+    if response.status_code == 304 and cached_levels is not None:
+        return cached_levels
+    response.raise_for_status()
+
+    ink_levels = parse_ink_levels(response.content, printer["profile"])
+
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["If-None-Match"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["If-Modified-Since"] = response.headers["Last-Modified"]
+    _printer_validators[printer["name"]] = (validators, ink_levels)
+    return ink_levels
+
+# ---- SNMP probe ----
+# อ่านระดับหมึกและสถานะเครื่องจาก Printer-MIB / HOST-RESOURCES-MIB ด้วย SNMPv2c GET
+# ขอทุก OID ของเครื่องใน request เดียว (UDP ไม่กี่ร้อย byte แทนการโหลดและ parse หน้าเว็บ)
+# ทุกเครื่องใช้ UDP socket เดียวบน asyncio event loop ของตัวเอง จับคู่คำตอบด้วย request-id
+# ถ้า SNMP ใช้ไม่ได้ (ไม่ตอบ, ไม่รองรับ OID, ระดับหมึกไม่ทราบ) จะกลับไปใช้หน้าเว็บของเครื่องนั้น
+SNMP_TIMEOUT = float(os.getenv("SNMP_TIMEOUT", "1"))
+SNMP_RETRIES = int(os.getenv("SNMP_RETRIES", "1"))
+# เครื่องที่ตอบว่าไม่รองรับจะใช้หน้าเว็บไปก่อนช่วงเวลานี้ แล้วค่อยลอง SNMP ใหม่
+SNMP_RETRY_AFTER = int(os.getenv("SNMP_RETRY_AFTER", "3600"))
+
+OID_SUPPLY_LEVEL = "1.3.6.1.2.1.43.11.1.1.9.1"      # prtMarkerSuppliesLevel.1.<index>
+OID_SUPPLY_MAX = "1.3.6.1.2.1.43.11.1.1.8.1"        # prtMarkerSuppliesMaxCapacity.1.<index>
+OID_DEVICE_STATUS = "1.3.6.1.2.1.25.3.2.1.5.1"      # hrDeviceStatus.1
+OID_PRINTER_STATUS = "1.3.6.1.2.1.25.3.5.1.1.1"     # hrPrinterStatus.1
+HR_DEVICE_STATUS = {1: "unknown", 2: "running", 3: "warning", 4: "testing", 5: "down"}
+HR_PRINTER_STATUS = {1: "other", 2: "unknown", 3: "idle", 4: "printing", 5: "warmup"}
+
+SNMP_GET = 0xA0
+SNMP_RESPONSE = 0xA2
+NO_SUCH_OBJECT = "noSuchObject"  # ค่าของ noSuchObject / noSuchInstance / endOfMibView
+
+def _ber_tlv(tag, payload):
+    length = len(payload)
+    if length < 0x80:
+        header = bytes([tag, length])
+    else:
+        size = length.to_bytes((length.bit_length() + 7) // 8, "big")
+        header = bytes([tag, 0x80 | len(size)]) + size
+    return header + payload
+
+def _ber_int(value, tag=0x02):
+    return _ber_tlv(tag, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True))
+
+def _ber_oid(oid):
+    parts = [int(part) for part in oid.split(".")]
+    payload = bytearray([parts[0] * 40 + parts[1]])
+    for part in parts[2:]:
+        chunk = [part & 0x7F]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7F))
+            part >>= 7
+        payload.extend(reversed(chunk))
+    return _ber_tlv(0x06, bytes(payload))
+
+def _ber_read(data, pos):
+    """อ่าน TLV หนึ่งตัวที่ตำแหน่ง pos คืนค่า (tag, payload, ตำแหน่งถัดไป)"""
+    tag, length = data[pos], data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        size = length & 0x7F
+        length = int.from_bytes(data[pos:pos + size], "big")
+        pos += size
+    if pos + length > len(data):
+        raise ValueError("Truncated BER value")
+    return tag, data[pos:pos + length], pos + length
+
+def _ber_decode_oid(payload):
+    parts = [payload[0] // 40, payload[0] % 40]
+    value = 0
+    for byte in payload[1:]:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            parts.append(value)
+            value = 0
+    return ".".join(str(part) for part in parts)
+
+def _ber_decode_value(tag, payload):
+    if tag == 0x02:
+        return int.from_bytes(payload, "big", signed=True)
+    if tag in (0x41, 0x42, 0x43, 0x46):  # Counter32, Gauge32, TimeTicks, Counter64
+        return int.from_bytes(payload, "big")
+    if tag == 0x04:
+        return bytes(payload)
+    if tag == 0x06:
+        return _ber_decode_oid(payload)
+    if tag in (0x80, 0x81, 0x82):
+        return NO_SUCH_OBJECT
+    return None
+
+def encode_snmp_message(pdu_type, request_id, community, varbinds, error_status=0, error_index=0):
+    """
+    สร้าง SNMPv2c message varbinds = [(oid, value), ...]
+    value: None = NULL, int = INTEGER, bytes = OCTET STRING, NO_SUCH_OBJECT
+    """
+    encoded = []
+    for oid, value in varbinds:
+        if value is None:
+            encoded_value = b"\x05\x00"
+        elif value == NO_SUCH_OBJECT:
+            encoded_value = b"\x80\x00"
+        elif isinstance(value, int):
+            encoded_value = _ber_int(value)
         else:
-            # ส่ง carousel
-            flex_content = {
-                "type": "carousel",
-                "contents": bubbles
-            }
-        
-        success_count = 0
-        for user_id, name in users:
+            encoded_value = _ber_tlv(0x04, bytes(value))
+        encoded.append(_ber_tlv(0x30, _ber_oid(oid) + encoded_value))
+    pdu = _ber_tlv(
+        pdu_type,
+        _ber_int(request_id) + _ber_int(error_status) + _ber_int(error_index) + _ber_tlv(0x30, b"".join(encoded))
+    )
+    return _ber_tlv(0x30, _ber_int(1) + _ber_tlv(0x04, community.encode()) + pdu)
+
+def decode_snmp_message(data):
+    """
+    แปลง SNMP message เป็น dict
+    {"pdu_type", "community", "request_id", "error_status", "varbinds": [(oid, value), ...]}
+    """
+    _, message, _ = _ber_read(data, 0)
+    _, version, pos = _ber_read(message, 0)
+    _, community, pos = _ber_read(message, pos)
+    pdu_type, pdu, _ = _ber_read(message, pos)
+    _, request_id, pos = _ber_read(pdu, 0)
+    _, error_status, pos = _ber_read(pdu, pos)
+    _, error_index, pos = _ber_read(pdu, pos)
+    _, varbind_list, _ = _ber_read(pdu, pos)
+    varbinds = []
+    pos = 0
+    while pos < len(varbind_list):
+        _, varbind, pos = _ber_read(varbind_list, pos)
+        _, oid, value_pos = _ber_read(varbind, 0)
+        value_tag, value, _ = _ber_read(varbind, value_pos)
+        varbinds.append((_ber_decode_oid(oid), _ber_decode_value(value_tag, value)))
+    return {
+        "pdu_type": pdu_type,
+        "community": bytes(community).decode(errors="replace"),
+        "request_id": int.from_bytes(request_id, "big", signed=True),
+        "error_status": int.from_bytes(error_status, "big", signed=True),
+        "varbinds": varbinds,
+    }
+
+_snmp_loop = None
+_snmp_transport = None
+_snmp_pending = {}  # request-id -> future ที่รอคำตอบ
+_snmp_lock = threading.Lock()
+_snmp_request_ids = itertools.count(random.randint(1, 1 << 30))
+_snmp_skip_until = {}  # printer name -> เวลาที่จะลอง SNMP อีกครั้ง
+
+class _SnmpProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        try:
+            message = decode_snmp_message(data)
+        except (ValueError, IndexError):
+            return  # packet เสียหรือไม่ใช่ SNMP
+        future = _snmp_pending.get(message["request_id"])
+        if future is not None and not future.done():
+            future.set_result(message)
+
+def _get_snmp_loop():
+    """event loop และ UDP socket สำหรับ SNMP (สร้างครั้งแรกที่ใช้งาน รันใน thread แยก)"""
+    global _snmp_loop, _snmp_transport
+    with _snmp_lock:
+        if _snmp_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="snmp", daemon=True).start()
+            _snmp_transport, _ = asyncio.run_coroutine_threadsafe(
+                loop.create_datagram_endpoint(_SnmpProtocol, local_addr=("0.0.0.0", 0)), loop
+            ).result()
+            _snmp_loop = loop
+        return _snmp_loop
+
+async def _snmp_get_async(host, port, packet, request_id, timeout, retries):
+    future = asyncio.get_running_loop().create_future()
+    _snmp_pending[request_id] = future
+    try:
+        for _ in range(retries + 1):
+            _snmp_transport.sendto(packet, (host, port))
             try:
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    flex_message = json.dumps(flex_content)
-                    message = FlexMessage(
-                        alt_text="Printer Status", 
-                        contents=FlexContainer.from_json(flex_message)
-                    )
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[message]
-                        )
-                    )
-                success_count += 1
-                print(f"Flex message sent to {name or user_id}")
-            except Exception as e:
-                print(f"Error sending flex message to {name or user_id}: {e}")
-        
-        print(f"Flex message sent successfully to {success_count}/{len(users)} users")
-    except Exception as e:
-        print(f"Error preparing flex message: {e}")
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                continue
+        raise TimeoutError(f"No SNMP response from {host}:{port}")
+    finally:
+        _snmp_pending.pop(request_id, None)
 
+def snmp_get(host, port, community, oids, timeout=SNMP_TIMEOUT, retries=SNMP_RETRIES):
+    """SNMPv2c GET หลาย OID ใน request เดียว คืนค่า {oid: value}"""
+    loop = _get_snmp_loop()
+    request_id = next(_snmp_request_ids) & 0x7FFFFFFF
+    packet = encode_snmp_message(SNMP_GET, request_id, community, [(oid, None) for oid in oids])
+    message = asyncio.run_coroutine_threadsafe(
+        _snmp_get_async(host, port, packet, request_id, timeout, retries), loop
+    ).result(timeout * (retries + 1) + 1)
+    if message["error_status"]:
+        raise ValueError(f"SNMP error-status {message['error_status']} from {host}")
+    return dict(message["varbinds"])
 
-def add_new_row(sheet_name, new_row):
-    sheet = client.open_by_url(sheet_url).worksheet(sheet_name)
-    sheet.append_row(new_row, value_input_option="USER_ENTERED")
+@timed("snmp_probe")
+def snmp_probe(printer, timeout=SNMP_TIMEOUT):
+    """
+    อ่านระดับหมึก (เปอร์เซ็นต์ ไม่ปัดเศษ) และสถานะเครื่องผ่าน SNMP
+    คืนค่า (ink_levels, {"device_status": ..., "printer_status": ...})
+    """
+    supplies = printer["snmp_supplies"]
+    oids = (
+        [f"{OID_SUPPLY_LEVEL}.{index}" for index in supplies]
+        + [f"{OID_SUPPLY_MAX}.{index}" for index in supplies]
+        + [OID_DEVICE_STATUS, OID_PRINTER_STATUS]
+    )
+    values = snmp_get(printer["snmp_host"], printer["snmp_port"], printer["snmp_community"], oids, timeout)
+
+    ink_levels = []
+    for index in supplies:
+        level = values.get(f"{OID_SUPPLY_LEVEL}.{index}")
+        capacity = values.get(f"{OID_SUPPLY_MAX}.{index}")
+        # level ติดลบ = ไม่ทราบ (-1 other, -2 unknown, -3 ยังเหลืออยู่บ้าง)
+        if not isinstance(level, int) or not isinstance(capacity, int) or level < 0 or capacity <= 0:
+            raise ValueError(f"Supply {index} level not available ({level}/{capacity})")
+        ink_levels.append(max(0, min(100, round(level * 100 / capacity))))
+    device = {
+        "device_status": HR_DEVICE_STATUS.get(values.get(OID_DEVICE_STATUS), "unknown"),
+        "printer_status": HR_PRINTER_STATUS.get(values.get(OID_PRINTER_STATUS), "unknown"),
+    }
+    return ink_levels, device
+
+def probe_printer(printer, timeout=PRINTER_TIMEOUT):
+    """
+    อ่านระดับหมึกด้วยวิธีที่ตั้งไว้ในทะเบียน คืนค่า (ink_levels, device status หรือ None)
+    SNMP ที่ใช้ไม่ได้จะกลับไปใช้หน้าเว็บ (scrape_printer) ของเครื่องเดียวกัน
+    """
+    name = printer["name"]
+    if printer["probe"] == "snmp" and time.time() >= _snmp_skip_until.get(name, 0):
+        try:
+            return snmp_probe(printer, min(timeout, SNMP_TIMEOUT))
+        except ValueError as e:
+            # เครื่องตอบแต่ไม่มีข้อมูลที่ต้องการ ใช้หน้าเว็บไปก่อนสักพัก
+            print(f"SNMP not usable for {name}, using web page for {SNMP_RETRY_AFTER}s: {e}")
+            _snmp_skip_until[name] = time.time() + SNMP_RETRY_AFTER
+        except OSError as e:
+            print(f"SNMP failed for {name}, falling back to web page: {e}")
+    return scrape_printer(printer, timeout), None
 
-def checkNetworkPrinter(printer_url,worksheet):
+@timed("checkNetworkPrinter")
+def checkNetworkPrinter(printer, timeout=PRINTER_TIMEOUT):
+    """
+    อ่านระดับหมึกจากเครื่องพิมพ์ (SNMP หรือหน้าเว็บ ตาม probe ในทะเบียน)
+    คืนค่าผลลัพธ์พร้อม sample ที่จะถูกบันทึกลงฐานข้อมูลโดย poll_printers
+    """
     try:
-        response_printer = requests.get(printer_url, timeout=10)
-        response_printer.raise_for_status()
-
-        soup_printer = BeautifulSoup(response_printer.text, "lxml")
-        toners_printer = soup_printer.find_all("img", class_="tonerremain")
-
-        new_row = [datetime.now(tz).strftime("%m/%d/%Y %H:%M:00")]
-
-        ink_levels = []
-
-        for img in toners_printer:
-            height = img.get("height")
-            if height and height.isdigit():
-                max_ink = os.getenv("MAX_INK")
-                percentage = int((int(height) * 100) / int(max_ink))
-                mapped_value = round(percentage / 10) * 10
-                mapped_value = max(0, min(100, mapped_value))
-                new_row.append(mapped_value)
-                ink_levels.append(mapped_value)
-        new_row.append(STATUS_PING["success"])
-        add_new_row(worksheet,new_row)
-        return {
+        ink_levels, device = probe_printer(printer, timeout)
+        if device and device["device_status"] == "down":
+            # เครื่องตอบ SNMP ได้แต่แจ้งว่าใช้งานไม่ได้ ถือเป็นการตรวจที่ล้มเหลวสำหรับ state machine
+            return {
+                "success": False,
+                "data": ink_levels,
+                "device": device,
+                "message": f"เครื่องพิมพ์แจ้งว่าใช้งานไม่ได้ ({device['printer_status']})",
+                "sample": _make_sample(printer, ink_levels, STATUS_PING["fault"])
+            }
+        result = {
             "success": True,
-            "data": ink_levels
-        }            
+            "data": ink_levels,
+            "sample": _make_sample(printer, ink_levels, STATUS_PING["success"])
+        }
+        if device:
+            result["device"] = device
+            result["message"] = f"{device['device_status']}, {device['printer_status']}"
+        return result
     except requests.exceptions.ConnectionError:
-        new_row = [datetime.now(tz).strftime("%m/%d/%Y %H:%M:00"),0,0,0,0,STATUS_PING["error"]]
-        add_new_row(worksheet,new_row)
         return {
             "success": False,
-            "message": "ไม่สามารถเชื่อมต่อกับเครื่องพิมพ์ได้"
+            "message": "ไม่สามารถเชื่อมต่อกับเครื่องพิมพ์ได้",
+            "sample": _make_sample(printer, None, STATUS_PING["error"])
         }
     except requests.exceptions.Timeout:
-        new_row = [datetime.now(tz).strftime("%m/%d/%Y %H:%M:00"),0,0,0,0,STATUS_PING["timeout"]]
-        add_new_row(worksheet,new_row)
         return {
             "success": False,
-            "message": "การเชื่อมต่อหมดเวลา"
+            "message": "การเชื่อมต่อหมดเวลา",
+            "sample": _make_sample(printer, None, STATUS_PING["timeout"])
         }
     except (requests.exceptions.HTTPError,requests.exceptions.RequestException):
-        new_row = [datetime.now(tz).strftime("%m/%d/%Y %H:%M:00"),0,0,0,0,STATUS_PING["error"]]
-        add_new_row(worksheet,new_row)
         return {
             "success": False,
-            "message": "ไม่สามารถเชื่อมต่อกับเครื่องพิมพ์ได้"
+            "message": "ไม่สามารถเชื่อมต่อกับเครื่องพิมพ์ได้",
+            "sample": _make_sample(printer, None, STATUS_PING["error"])
         }
     except Exception as e:
-        new_row = [datetime.now(tz).strftime("%m/%d/%Y %H:%M:00"),0,0,0,0,STATUS_PING["error"]]
-        add_new_row(worksheet,new_row)
         return {
             "success": False,
-            "message": "เกิดข้อผิดพลาดที่ไม่คาดคิด"
+            "message": "เกิดข้อผิดพลาดที่ไม่คาดคิด",
+            "sample": _make_sample(printer, None, STATUS_PING["error"])
         }
 
+_poll_executor = ThreadPoolExecutor(max_workers=POLL_MAX_WORKERS, thread_name_prefix="poll")
+
+# ผลการตรวจสอบล่าสุดของแต่ละเครื่อง สำหรับ /status เก็บในตาราง printer_snapshot
+# เพื่อให้ทุก worker process เห็นข้อมูลเดียวกัน
+_status_written_at = None  # updated_at ของรอบล่าสุดที่ process นี้เขียนเอง
+
+def _update_status_snapshot(printers, results):
+    global _status_written_at
+    now = time.time()
+    rows = []
+    for printer, result in zip(printers, results):
+        sample = result["sample"]
+        rows.append((
+            printer["name"], printer["lab"], int(result["success"]), json.dumps(sample["levels"]),
+            sample["status"], result.get("message"), sample["ts"], now,
+        ))
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO printer_snapshot '
+            '(printer, lab, success, levels, status, message, ts, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+    _status_written_at = now
+
+def get_status_snapshot():
+    rows = get_db().execute(
+        'SELECT printer, lab, success, levels, status, message, ts, updated_at FROM printer_snapshot'
+    ).fetchall()
+    snapshot = {
+        name: {
+            "name": name,
+            "lab": lab,
+            "success": bool(success),
+            "levels": json.loads(levels),
+            "status": status,
+            "message": message,
+            "ts": ts,
+        }
+        for name, lab, success, levels, status, message, ts, updated_at in rows
+    }
+    return {
+        "updated_at": max((row[7] for row in rows), default=None),
+        "printers": [snapshot[name] for name in PRINTERS if name in snapshot],
+    }
+
+def _sync_shared_state():
+    """
+    ถ้า process อื่นตรวจสอบเครื่องพิมพ์ไปหลังรอบล่าสุดของ process นี้
+    ให้ล้าง state machine ใน memory แล้วโหลดจาก DB ใหม่ (forecast ตามทันเองจาก samples)
+    """
+    global _status_written_at, _printer_states
+    latest = get_db().execute('SELECT MAX(updated_at) FROM printer_snapshot').fetchone()[0]
+    if latest is None or latest == _status_written_at:
+        return
+    with _printer_states_lock:
+        _printer_states = None
+    _status_written_at = latest
+
+@timed("poll_printers")
+def poll_printers(printers, timeout=PRINTER_TIMEOUT):
+    """
+    ตรวจสอบเครื่องพิมพ์หลายเครื่องพร้อมกัน
+    printers = รายการเครื่องพิมพ์จากทะเบียน (ค่าใน PRINTERS)
+    คืนค่าผลลัพธ์ของ checkNetworkPrinter ตามลำดับเดียวกับ printers
+    เวลารวมจะใกล้เคียงกับเครื่องที่ช้าที่สุด ไม่ใช่ผลรวมของทุกเครื่อง
+    เครื่องที่ตรวจได้จะได้ sample หนึ่งรายการต่อรอบ ซึ่งถูกบันทึกลงฐานข้อมูลในครั้งเดียว
+    เครื่องที่ไม่ได้ตรวจเพราะรอคิวนานเกินไปจะได้ {"skipped": True} และไม่มี sample
+    """
+    # requests ใช้ timeout ต่อการอ่านแต่ละครั้ง จึงกำหนด deadline ของแต่ละเครื่องซ้ำอีกชั้น
+    # โดยนับจากเวลาที่เริ่มตรวจเครื่องนั้นจริง ไม่ใช่เวลาที่ใส่เข้าคิวของ thread pool
+    limit = timeout * 3
+    started = [None] * len(printers)
+
+    def check(index, printer):
+        started[index] = time.monotonic()
+        return checkNetworkPrinter(printer, timeout)
+
+    futures = [
+        _poll_executor.submit(check, index, printer)
+        for index, printer in enumerate(printers)
+    ]
+    # เครื่องที่ยังไม่ได้เริ่มเมื่อครบเวลาของทุกรอบคิวแล้ว (เช่น thread ถูกเครื่องที่ค้างจับไว้) จะถูกยกเลิก
+    rounds = -(-len(printers) // POLL_MAX_WORKERS)
+    queue_deadline = time.monotonic() + limit * rounds
+    overdue = set()
+    while True:
+        now = time.monotonic()
+        if now >= queue_deadline:
+            for future in futures:
+                future.cancel()  # ยกเลิกได้เฉพาะงานที่ยังไม่เริ่ม
+        # หลัง queue_deadline ไม่นับเวลานั้นอีก ไม่งั้น timeout ของ wait จะเป็น 0 ตลอด (วนไม่หยุดพัก)
+        pending, deadlines = [], [queue_deadline] if now < queue_deadline else []
+        for index, future in enumerate(futures):
+            if future.done() or index in overdue:
+                continue
+            if started[index] is not None:
+                if now >= started[index] + limit:
+                    overdue.add(index)
+                    continue
+                deadlines.append(started[index] + limit)
+            pending.append(future)
+        if not pending:
+            break
+        # ไม่มี deadline = งานเพิ่งเริ่มแต่ยังไม่ได้บันทึกเวลาเริ่ม รอสั้นๆ แล้วดูใหม่
+        timeout = max(0.0, min(deadlines) - now) if deadlines else 0.01
+        wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+    results = []
+    for printer, future in zip(printers, futures):
+        if future.cancelled():
+            results.append({
+                "success": False,
+                "skipped": True,
+                "message": "ไม่ได้ตรวจสอบ (รอคิวนานเกินไป)",
+                "sample": None
+            })
+        elif not future.done():
+            results.append({
+                "success": False,
+                "message": "การเชื่อมต่อหมดเวลา",
+                "sample": _make_sample(printer, None, STATUS_PING["timeout"])
+            })
+        elif future.exception() is not None:
+            print(f"Error polling {printer['name']}: {future.exception()}")
+            results.append({
+                "success": False,
+                "message": "เกิดข้อผิดพลาดที่ไม่คาดคิด",
+                "sample": _make_sample(printer, None, STATUS_PING["error"])
+            })
+        else:
+            results.append(future.result())
+
+    skipped = [printer["name"] for printer, result in zip(printers, results) if result.get("skipped")]
+    if skipped:
+        print(f"Skipped {len(skipped)} printers still waiting for a poll thread: {', '.join(skipped)}")
+    # เฉพาะเครื่องที่ตรวจจริงเท่านั้นที่ถูกบันทึก และส่งต่อให้ state machine
+    checked = [(printer, result) for printer, result in zip(printers, results) if not result.get("skipped")]
+    checked_printers = [printer for printer, _ in checked]
+    checked_results = [result for _, result in checked]
+    samples = [result["sample"] for result in checked_results]
+    alerts = []
+    # อัปเดต state ทีละรอบแม้มีหลาย worker process เพื่อให้ state machine และ forecast ไม่ชนกัน
+    with process_lock("poll"):
+        _sync_shared_state()
+        _update_status_snapshot(checked_printers, checked_results)
+        try:
+            record_samples(samples)
+        except Exception as e:
+            print(f"Error recording samples: {e}")
+        try:
+            update_forecasts()
+        except Exception as e:
+            print(f"Error updating forecasts: {e}")
+        try:
+            update_rollups(samples)
+        except Exception as e:
+            print(f"Error updating rollups: {e}")
+        try:
+            alerts = update_printer_states(checked_printers, checked_results)
+        except Exception as e:
+            print(f"Error updating printer states: {e}")
+    if alerts:
+        try:
+            send_text_message("⚠️ แจ้งเตือนสถานะเครื่องพิมพ์:\n" + "\n".join(alerts))
+        except Exception as e:
+            print(f"Error sending printer state alerts: {e}")
+    export_samples_to_sheet(samples)
+    return results
+
+# ---- Ink depletion forecast ----
+# เก็บผลรวมสำหรับ linear regression (ระดับหมึก vs เวลา) ของแต่ละสีแบบ incremental
+# ต่อเครื่องพิมพ์ภายในหน้าต่าง FORECAST_WINDOW_DAYS วัน คำนวณทั้ง 4 สีพร้อมกันด้วย numpy
+# sample ใหม่ใช้เวลา O(1) ไม่ต้องคำนวณจากประวัติทั้งหมด
+# state ตามทันจากตาราง samples ด้วย id ที่เพิ่มขึ้นเรื่อยๆ ทุก worker process จึงเห็น sample
+# ที่ process อื่นบันทึกโดยไม่ต้องโหลดประวัติย้อนหลังใหม่
+INK_COLORS = ["M", "C", "Y", "BK"]
+FORECAST_WINDOW_DAYS = float(os.getenv("FORECAST_WINDOW_DAYS", "30"))
+FORECAST_IN_DAILY = os.getenv("FORECAST_IN_DAILY", "false").lower() == "true"
+FORECAST_ALERT_DAYS = float(os.getenv("FORECAST_ALERT_DAYS", "14"))
+# ระดับหมึกเพิ่มขึ้นเกินค่านี้ถือว่าเปลี่ยนตลับใหม่ เริ่มนับอัตราการใช้ของสีนั้นใหม่
+REFILL_JUMP = 20
+# อัตราการใช้ที่น้อยมากจะให้วันหมดไกลเกินจริง เกินค่านี้ถือว่ายังไม่มีแนวโน้มหมด
+FORECAST_MAX_DAYS = 3650
+_FORECAST_EPOCH = 1_600_000_000  # ลดขนาดตัวเลขเวลาเพื่อความแม่นยำของผลรวม
+
+_forecast_state = {}   # printer name -> state
+_forecast_cache = {}   # printer name -> ผลลัพธ์ที่คำนวณแล้ว (ล้างเมื่อมี sample ใหม่)
+_forecast_lock = threading.Lock()
+_forecast_loaded = False
+_forecast_last_id = 0  # id ของ sample ล่าสุดที่รวมเข้า state แล้ว
+
+def _days(ts):
+    return (ts - _FORECAST_EPOCH) / 86400.0
+
+def _new_forecast_state():
+    import numpy as np
+    return {
+        "window": deque(),            # [(t, levels), ...]
+        "since": np.full(4, -np.inf), # เวลาเปลี่ยนตลับล่าสุดของแต่ละสี
+        "n": np.zeros(4),
+        "st": np.zeros(4),
+        "stt": np.zeros(4),
+        "sy": np.zeros(4),
+        "sty": np.zeros(4),
+        "last": None,
+        "last_ts": None,
+    }
+
+def _forecast_add(state, ts, levels):
+    """เพิ่ม sample หนึ่งรายการเข้า state และตัด sample ที่เก่ากว่าหน้าต่างออก"""
+    import numpy as np
+    t = _days(ts)
+    y = np.asarray(levels, dtype=float)
+    if state["last"] is not None:
+        refill = y > state["last"] + REFILL_JUMP
+        if refill.any():
+            for key in ("n", "st", "stt", "sy", "sty"):
+                state[key][refill] = 0.0
+            state["since"][refill] = t
+
+    state["window"].append((t, y))
+    state["n"] += 1
+    state["st"] += t
+    state["stt"] += t * t
+    state["sy"] += y
+    state["sty"] += t * y
+
+    window = state["window"]
+    while window and window[0][0] < t - FORECAST_WINDOW_DAYS:
+        t0, y0 = window.popleft()
+        mask = (t0 >= state["since"]).astype(float)
+        state["n"] -= mask
+        state["st"] -= mask * t0
+        state["stt"] -= mask * t0 * t0
+        state["sy"] -= mask * y0
+        state["sty"] -= mask * t0 * y0
+
+    state["last"] = y
+    state["last_ts"] = ts
+
+def _forecast_state_from_rows(rows):
+    """สร้าง state จากประวัติใน DB ทีเดียวด้วย numpy (ใช้ตอนเริ่มต้น)"""
+    import numpy as np
+    state = _new_forecast_state()
+    if not rows:
+        return state
+    ts = np.array([row[0] for row in rows], dtype=float)
+    levels = np.array([row[1:5] for row in rows], dtype=float)
+    t = _days(ts)
+
+    since = np.full(4, -np.inf)
+    if len(rows) > 1:
+        jumps = np.diff(levels, axis=0) > REFILL_JUMP
+        for i in range(4):
+            idx = np.flatnonzero(jumps[:, i])
+            if idx.size:
+                since[i] = t[idx[-1] + 1]
+
+    mask = (t[:, None] >= since[None, :]).astype(float)
+    tm = t[:, None] * mask
+    state["since"] = since
+    state["n"] = mask.sum(axis=0)
+    state["st"] = tm.sum(axis=0)
+    state["stt"] = (tm * t[:, None]).sum(axis=0)
+    state["sy"] = (levels * mask).sum(axis=0)
+    state["sty"] = (levels * tm).sum(axis=0)
+    state["window"] = deque(zip(t.tolist(), levels))
+    state["last"] = levels[-1]
+    state["last_ts"] = int(ts[-1])
+    return state
+
+def _ensure_forecast_loaded():
+    """โหลดประวัติย้อนหลังจาก DB ครั้งแรกที่ใช้งาน (ต้องถือ _forecast_lock)"""
+    global _forecast_loaded, _forecast_last_id
+    if _forecast_loaded:
+        return
+    conn = get_db()
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM samples').fetchone()[0]
+    start = int(time.time() - FORECAST_WINDOW_DAYS * 86400)
+    for name in PRINTERS:
+        rows = conn.execute(
+            'SELECT ts, m, c, y, bk FROM samples WHERE printer = ? AND ts >= ? AND id <= ? AND status = ? '
+            'AND m IS NOT NULL AND c IS NOT NULL AND y IS NOT NULL AND bk IS NOT NULL ORDER BY ts',
+            (name, start, last_id, STATUS_PING["success"])
+        ).fetchall()
+        _forecast_state[name] = _forecast_state_from_rows(rows)
+    _forecast_last_id = last_id
+    _forecast_loaded = True
+
+def _forecast_catch_up():
+    """รวม sample ที่ถูกบันทึกหลังรอบก่อน (จากทุก process) เข้า state (ต้องถือ _forecast_lock)"""
+    global _forecast_last_id
+    rows = get_db().execute(
+        'SELECT id, printer, ts, m, c, y, bk, status FROM samples WHERE id > ? ORDER BY id',
+        (_forecast_last_id,)
+    ).fetchall()
+    for sample_id, printer, ts, m, c, y, bk, status in rows:
+        _forecast_last_id = sample_id
+        levels = [m, c, y, bk]
+        if status != STATUS_PING["success"] or None in levels:
+            continue
+        state = _forecast_state.setdefault(printer, _new_forecast_state())
+        _forecast_add(state, ts, levels)
+        _forecast_cache.pop(printer, None)
+
+def update_forecasts():
+    """อัปเดต state ด้วย sample ใหม่ที่บันทึกแล้ว (เฉพาะที่อ่านระดับหมึกได้ครบ 4 สี)"""
+    with _forecast_lock:
+        _ensure_forecast_loaded()
+        _forecast_catch_up()
+
+def _compute_forecast(state):
+    import numpy as np
+    if state["last"] is None:
+        return None
+    n, st, stt, sy, sty = state["n"], state["st"], state["stt"], state["sy"], state["sty"]
+    denom = n * stt - st * st
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where((n >= 2) & (denom > 1e-9), (n * sty - st * sy) / denom, np.nan)
+    rate = -slope  # เปอร์เซ็นต์ที่ใช้ไปต่อวัน
+
+    result = {"updated_at": state["last_ts"], "colors": {}}
+    for i, color in enumerate(INK_COLORS):
+        level = float(state["last"][i])
+        entry = {"level": level, "rate_per_day": None, "days_left": None, "empty_date": None}
+        if not np.isnan(rate[i]):
+            entry["rate_per_day"] = round(float(rate[i]), 2) + 0.0  # ไม่ให้แสดง -0.0
+            days_left = level / rate[i] if rate[i] > 0 else np.inf
+            if days_left <= FORECAST_MAX_DAYS:
+                entry["days_left"] = round(float(days_left), 1)
+                entry["empty_date"] = datetime.fromtimestamp(
+                    state["last_ts"] + days_left * 86400, tz
+                ).strftime("%Y-%m-%d")
+        result["colors"][color] = entry
+    return result
+
+def get_forecast(printer_name):
+    """คืนค่าคาดการณ์วันหมึกหมดของเครื่องพิมพ์ (ใช้ผลที่ cache ไว้ถ้าไม่มี sample ใหม่)"""
+    with _forecast_lock:
+        _ensure_forecast_loaded()
+        _forecast_catch_up()
+        if printer_name not in _forecast_cache:
+            state = _forecast_state.get(printer_name)
+            _forecast_cache[printer_name] = _compute_forecast(state) if state else None
+        return _forecast_cache[printer_name]
+
+def forecast_summary_text(printer_names):
+    """ข้อความสรุปสีที่คาดว่าจะหมดภายใน FORECAST_ALERT_DAYS วัน คืนค่า None ถ้าไม่มี"""
+    lines = []
+    for name in printer_names:
+        forecast = get_forecast(name)
+        if not forecast:
+            continue
+        for color, entry in forecast["colors"].items():
+            if entry["days_left"] is not None and entry["days_left"] <= FORECAST_ALERT_DAYS:
+                lines.append(f"{name} {color}: ~{entry['days_left']:.0f} วัน ({entry['empty_date']})")
+    if not lines:
+        return None
+    return "🖨️ หมึกที่คาดว่าจะหมดเร็วๆ นี้:\n" + "\n".join(lines)
+
+# ---- Printer state tracking ----
+# แจ้งเตือนเฉพาะเมื่อสถานะเปลี่ยน แทนการแจ้งซ้ำทุกครั้งที่ตรวจพบปัญหา
+#   up       = เชื่อมต่อได้ปกติ
+#   degraded = เชื่อมต่อไม่ได้แต่ยังไม่ครบ DOWN_AFTER ครั้งติดกัน (ยังไม่แจ้ง)
+#   down     = เชื่อมต่อไม่ได้ครบ DOWN_AFTER ครั้ง (แจ้งครั้งเดียว)
+# down -> up ต้องเชื่อมต่อได้ RECOVER_AFTER ครั้งติดกัน แล้วแจ้งว่ากลับมาปกติครั้งเดียว
+# ถ้าหลุดบ่อยเกิน FLAP_LIMIT ครั้งใน FLAP_WINDOW วินาที จะหยุดแจ้งชั่วคราวจนกว่าจะนิ่ง
+# หมึกแต่ละสีแจ้งเมื่อต่ำกว่า low_ink_threshold และจะแจ้งใหม่ได้หลังเติมเกิน threshold + LOW_INK_CLEAR_MARGIN
+DOWN_AFTER = int(os.getenv("DOWN_AFTER", "2"))
+RECOVER_AFTER = int(os.getenv("RECOVER_AFTER", "2"))
+FLAP_LIMIT = int(os.getenv("FLAP_LIMIT", "3"))
+FLAP_WINDOW = int(os.getenv("FLAP_WINDOW", str(6 * 3600)))
+LOW_INK_CLEAR_MARGIN = 20
+
+_printer_states = None
+_printer_states_lock = threading.Lock()
+
+def _new_printer_state():
+    return {
+        "state": "up", "fail_count": 0, "ok_count": 0, "changed_at": None,
+        "flap_times": [], "flapping": False, "low_colors": [],
+    }
+
+def _load_printer_states():
+    """โหลดสถานะจาก DB ครั้งแรกที่ใช้งาน (ต้องถือ _printer_states_lock)"""
+    global _printer_states
+    if _printer_states is None:
+        _printer_states = {}
+        rows = get_db().execute(
+            'SELECT printer, state, fail_count, ok_count, changed_at, flap_times, flapping, low_colors '
+            'FROM printer_state'
+        ).fetchall()
+        for name, state, fail_count, ok_count, changed_at, flap_times, flapping, low_colors in rows:
+            _printer_states[name] = {
+                "state": state, "fail_count": fail_count, "ok_count": ok_count,
+                "changed_at": changed_at, "flap_times": json.loads(flap_times),
+                "flapping": bool(flapping), "low_colors": json.loads(low_colors),
+            }
+    return _printer_states
+
+def _save_printer_states(names):
+    rows = []
+    for name in names:
+        state = _printer_states[name]
+        rows.append((
+            name, state["state"], state["fail_count"], state["ok_count"], state["changed_at"],
+            json.dumps(state["flap_times"]), int(state["flapping"]), json.dumps(state["low_colors"]),
+        ))
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO printer_state '
+            '(printer, state, fail_count, ok_count, changed_at, flap_times, flapping, low_colors) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+
+def _transition(printer, state, result, now):
+    """อัปเดต state ของเครื่องหนึ่งเครื่องจากผลการตรวจสอบ คืนค่ารายการข้อความแจ้งเตือน"""
+    name = printer["name"]
+    alerts = []
+    previous = state["state"]
+
+    if result["success"]:
+        state["fail_count"] = 0
+        state["ok_count"] += 1
+        if previous == "degraded":
+            state["state"] = "up"
+        elif previous == "down" and state["ok_count"] >= RECOVER_AFTER:
+            state["state"] = "up"
+            if not state["flapping"]:
+                alerts.append(f"✅ {name}: กลับมาเชื่อมต่อได้ปกติแล้ว")
+    else:
+        state["ok_count"] = 0
+        state["fail_count"] += 1
+        if previous != "down":
+            if state["fail_count"] >= DOWN_AFTER:
+                state["state"] = "down"
+                state["flap_times"] = [t for t in state["flap_times"] if now - t <= FLAP_WINDOW] + [now]
+                if not state["flapping"] and len(state["flap_times"]) >= FLAP_LIMIT:
+                    state["flapping"] = True
+                    alerts.append(f"⚠️ {name}: หลุดการเชื่อมต่อบ่อย จะหยุดแจ้งเตือนชั่วคราวจนกว่าจะเสถียร")
+                elif not state["flapping"]:
+                    alerts.append(f"❌ {name}: {result['message']}")
+            else:
+                state["state"] = "degraded"
+
+    if state["state"] != previous:
+        state["changed_at"] = now
+
+    # หยุดพักการแจ้งเตือนเมื่อหลุดบ่อย จนกว่าจำนวนครั้งในหน้าต่างเวลาจะลดลง
+    state["flap_times"] = [t for t in state["flap_times"] if now - t <= FLAP_WINDOW]
+    if state["flapping"] and len(state["flap_times"]) < FLAP_LIMIT and state["state"] != "degraded":
+        state["flapping"] = False
+        current = "เชื่อมต่อได้ปกติ" if state["state"] == "up" else "ยังเชื่อมต่อไม่ได้"
+        alerts.append(f"ℹ️ {name}: กลับมาแจ้งเตือนตามปกติ (สถานะปัจจุบัน: {current})")
+
+    # low ink
+    if result["success"]:
+        threshold = printer["low_ink_threshold"]
+        low_colors = set(state["low_colors"])
+        for color, level in zip(INK_COLORS, result["data"]):
+            if color not in low_colors and level <= threshold:
+                low_colors.add(color)
+                alerts.append(f"🖨️ {name}: หมึก {color} ใกล้หมด ({level}%)")
+            elif color in low_colors and level >= threshold + LOW_INK_CLEAR_MARGIN:
+                low_colors.discard(color)
+        state["low_colors"] = sorted(low_colors)
+
+    return alerts
+
+def update_printer_states(printers, results):
+    """อัปเดตสถานะทุกเครื่องจากผลการตรวจสอบหนึ่งรอบ คืนค่าข้อความที่ต้องแจ้งเตือน"""
+    now = int(time.time())
+    alerts = []
+    with _printer_states_lock:
+        states = _load_printer_states()
+        for printer, result in zip(printers, results):
+            state = states.setdefault(printer["name"], _new_printer_state())
+            alerts.extend(_transition(printer, state, result, now))
+        _save_printer_states([printer["name"] for printer in printers])
+    return alerts
+
+def get_printer_state(name):
+    with _printer_states_lock:
+        state = _load_printer_states().get(name)
+        return dict(state) if state else None
+
+def get_printer_states():
+    _sync_shared_state()
+    with _printer_states_lock:
+        return {name: dict(state) for name, state in _load_printer_states().items()}
+
+# ---- Rollups ----
+# สรุปรายวันและรายสัปดาห์ต่อเครื่องพิมพ์ อัปเดตทุกครั้งที่มี sample ใหม่ (upsert ผลรวม)
+# ไม่ต้องสแกน samples ทั้งหมดเมื่อเปิด dashboard
+#   uptime %       = ok_polls / polls
+#   unreachable    = จำนวนครั้งที่ timeout หรือเชื่อมต่อไม่ได้
+#   min/avg        = ระดับหมึกต่ำสุด/เฉลี่ยของแต่ละสีจาก sample ที่อ่านได้
+#   used           = ผลรวมระดับหมึกที่ลดลงระหว่าง sample ที่อ่านได้ติดกัน (ไม่นับตอนเปลี่ยนตลับ)
+ROLLUP_PERIODS = ("day", "week")
+ROLLUP_WEEKLY_SUMMARY = os.getenv("ROLLUP_WEEKLY_SUMMARY", "false").lower() == "true"
+
+_ROLLUP_UPSERT = '''
+    INSERT INTO rollups (
+        period, bucket, printer, polls, ok_polls, unreachable, level_count,
+        m_min, c_min, y_min, bk_min, m_sum, c_sum, y_sum, bk_sum, m_used, c_used, y_used, bk_used
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (period, bucket, printer) DO UPDATE SET
+        polls = polls + excluded.polls,
+        ok_polls = ok_polls + excluded.ok_polls,
+        unreachable = unreachable + excluded.unreachable,
+        level_count = level_count + excluded.level_count,
+        m_min = COALESCE(MIN(m_min, excluded.m_min), m_min, excluded.m_min),
+        c_min = COALESCE(MIN(c_min, excluded.c_min), c_min, excluded.c_min),
+        y_min = COALESCE(MIN(y_min, excluded.y_min), y_min, excluded.y_min),
+        bk_min = COALESCE(MIN(bk_min, excluded.bk_min), bk_min, excluded.bk_min),
+        m_sum = m_sum + excluded.m_sum,
+        c_sum = c_sum + excluded.c_sum,
+        y_sum = y_sum + excluded.y_sum,
+        bk_sum = bk_sum + excluded.bk_sum,
+        m_used = m_used + excluded.m_used,
+        c_used = c_used + excluded.c_used,
+        y_used = y_used + excluded.y_used,
+        bk_used = bk_used + excluded.bk_used
+'''
+
+def rollup_buckets(ts):
+    """คืนค่า {period: bucket} ของเวลา ts (วันที่ และวันจันทร์ของสัปดาห์ ตามเวลาไทย)"""
+    day = datetime.fromtimestamp(ts, tz).date()
+    return {"day": day.isoformat(), "week": (day - timedelta(days=day.weekday())).isoformat()}
+
+def _new_rollup_delta():
+    return {"polls": 0, "ok_polls": 0, "unreachable": 0, "level_count": 0,
+            "min": [None] * 4, "sum": [0] * 4, "used": [0] * 4}
+
+def _rollup_add(delta, sample, previous_levels):
+    """เพิ่ม sample เข้า delta previous_levels = ระดับหมึกที่อ่านได้ครั้งก่อนหน้า (หรือ None)"""
+    delta["polls"] += 1
+    levels = sample["levels"]
+    if sample["status"] == STATUS_PING["success"]:
+        delta["ok_polls"] += 1
+        if len(levels) >= 4 and None not in levels[:4]:
+            delta["level_count"] += 1
+            for i, level in enumerate(levels[:4]):
+                current_min = delta["min"][i]
+                delta["min"][i] = level if current_min is None else min(current_min, level)
+                delta["sum"][i] += level
+                if previous_levels is not None and previous_levels[i] is not None:
+                    delta["used"][i] += max(0, previous_levels[i] - level)
+    elif sample["status"] in (STATUS_PING["timeout"], STATUS_PING["error"]):
+        delta["unreachable"] += 1
+
+def _save_rollup_deltas(conn, deltas):
+    conn.executemany(_ROLLUP_UPSERT, [
+        (period, bucket, printer, delta["polls"], delta["ok_polls"], delta["unreachable"],
+         delta["level_count"], *delta["min"], *delta["sum"], *delta["used"])
+        for (period, bucket, printer), delta in deltas.items()
+    ])
+
+def _previous_levels(conn, printer, ts):
+    row = conn.execute(
+        'SELECT m, c, y, bk FROM samples WHERE printer = ? AND ts < ? AND status = ? '
+        'ORDER BY ts DESC LIMIT 1',
+        (printer, ts, STATUS_PING["success"])
+    ).fetchone()
+    return list(row) if row else None
+
+def update_rollups(samples):
+    """อัปเดต rollup ด้วย sample ใหม่ (เรียกหลัง record_samples)"""
+    conn = get_db()
+    deltas = {}
+    for sample in samples:
+        previous = _previous_levels(conn, sample["printer"], sample["ts"])
+        for period, bucket in rollup_buckets(sample["ts"]).items():
+            delta = deltas.setdefault((period, bucket, sample["printer"]), _new_rollup_delta())
+            _rollup_add(delta, sample, previous)
+    with conn:
+        _save_rollup_deltas(conn, deltas)
+
+def rebuild_rollups(chunk_size=EXPORT_CHUNK_SIZE):
+    """คำนวณ rollup ใหม่ทั้งหมดจาก samples (ใช้ครั้งแรกหลังอัปเกรด หรือเมื่อข้อมูลไม่ตรง)"""
+    deltas = {}
+    previous = {}
+    for rows in iter_sample_chunks(list(PRINTERS), chunk_size=chunk_size):
+        for printer, ts, m, c, y, bk, status in rows:
+            sample = {"printer": printer, "ts": ts, "levels": [m, c, y, bk], "status": status}
+            for period, bucket in rollup_buckets(ts).items():
+                delta = deltas.setdefault((period, bucket, printer), _new_rollup_delta())
+                _rollup_add(delta, sample, previous.get(printer))
+            if status == STATUS_PING["success"] and None not in (m, c, y, bk):
+                previous[printer] = [m, c, y, bk]
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM rollups')
+        _save_rollup_deltas(conn, deltas)
+    print(f"Rebuilt {len(deltas)} rollup rows")
+
+def _rebuild_rollups_if_empty():
+    conn = get_db()
+    if conn.execute('SELECT 1 FROM rollups LIMIT 1').fetchone() is None \
+            and conn.execute('SELECT 1 FROM samples LIMIT 1').fetchone() is not None:
+        with process_lock("poll"):
+            rebuild_rollups()
+
+def get_rollups(period="day", printers=None, start=None, end=None):
+    """
+    คืนค่า rollup ของช่วง bucket [start, end) (YYYY-MM-DD) เรียงตามเครื่องพิมพ์และเวลา
+    """
+    query = (
+        'SELECT bucket, printer, polls, ok_polls, unreachable, level_count, '
+        'm_min, c_min, y_min, bk_min, m_sum, c_sum, y_sum, bk_sum, m_used, c_used, y_used, bk_used '
+        'FROM rollups WHERE period = ?'
+    )
+    params = [period]
+    if printers:
+        query += f' AND printer IN ({",".join("?" * len(printers))})'
+        params.extend(printers)
+    if start is not None:
+        query += ' AND bucket >= ?'
+        params.append(start)
+    if end is not None:
+        query += ' AND bucket < ?'
+        params.append(end)
+    rows = get_db().execute(query + ' ORDER BY printer, bucket', params).fetchall()
+
+    result = []
+    for bucket, printer, polls, ok_polls, unreachable, level_count, *values in rows:
+        mins, sums, used = values[0:4], values[4:8], values[8:12]
+        result.append({
+            "period": period,
+            "bucket": bucket,
+            "printer": printer,
+            "polls": polls,
+            "uptime_pct": round(ok_polls * 100 / polls, 1) if polls else None,
+            "unreachable": unreachable,
+            "colors": {
+                color: {
+                    "min": mins[i],
+                    "avg": round(sums[i] / level_count, 1) if level_count else None,
+                    "used": used[i],
+                }
+                for i, color in enumerate(INK_COLORS)
+            },
+        })
+    return result
+
+@app.get("/rollups")
+async def rollups(period: str = "day", printer: list[str] = Query(None), start: str = None, end: str = None):
+    """
+    สรุปรายวัน/รายสัปดาห์ เช่น /rollups?period=week&printer=Printer_1&start=2024-01-01
+    ไม่ระบุ start = 30 วัน (day) หรือ 12 สัปดาห์ (week) ล่าสุด
+    """
+    if period not in ROLLUP_PERIODS:
+        return JSONResponse({"status": "error", "message": "period ต้องเป็น day หรือ week"}, status_code=400)
+    unknown = [name for name in printer or [] if get_printer(name) is None]
+    if unknown:
+        return JSONResponse({"status": "error", "message": f"ไม่พบเครื่องพิมพ์: {', '.join(unknown)}"}, status_code=404)
+    if start is None:
+        days = 30 if period == "day" else 12 * 7
+        start = rollup_buckets(time.time() - days * 86400)[period]
+    return {"period": period, "rollups": get_rollups(period, printer, start, end)}
+
+def weekly_summary_text(week=None):
+    """ข้อความสรุปของสัปดาห์ week (YYYY-MM-DD วันจันทร์) ไม่ระบุ = สัปดาห์ที่แล้ว"""
+    if week is None:
+        week = rollup_buckets(time.time() - 7 * 86400)["week"]
+    week_start = datetime.strptime(week, "%Y-%m-%d")
+    next_week = (week_start + timedelta(days=7)).strftime("%Y-%m-%d")
+    rows = {row["printer"]: row for row in get_rollups("week", start=week, end=next_week)}
+    if not rows:
+        return None
+    week_end = (week_start + timedelta(days=6)).strftime("%Y-%m-%d")
+    lines = [f"📊 สรุปประจำสัปดาห์ {week} ถึง {week_end}:"]
+    for name in PRINTERS:
+        row = rows.get(name)
+        if row is None:
+            continue
+        used = " ".join(f"{color} {row['colors'][color]['used']}" for color in INK_COLORS)
+        lines.append(
+            f"- {name}: ออนไลน์ {row['uptime_pct']}% (ติดต่อไม่ได้ {row['unreachable']} ครั้ง) "
+            f"ใช้หมึก {used}"
+        )
+    return "\n".join(lines)
+
+def job_weekly_summary():
+    """ส่งสรุปสัปดาห์ที่แล้ว (ส่งครั้งเดียวต่อสัปดาห์แม้ job ถูกเรียกซ้ำ)"""
+    week = rollup_buckets(time.time() - 7 * 86400)["week"]
+    text = weekly_summary_text(week)
+    if text:
+        send_text_message(text, key=f"weekly-summary:{week}")
+
 def job_7am():
     """ทำงานเวลา 7:00 น. - ส่งทั้ง flex message และ text message"""
-    result_printer_1 = checkNetworkPrinter(printer_1_url, worksheet_printer_1)
-    result_printer_2 = checkNetworkPrinter(printer_2_url, worksheet_printer_2)
+    printers = list(PRINTERS.values())
+    results = poll_printers(printers)
     
-    success_count = 0
+    printer_data = []
     error_messages = []
     
-    printer_1_data = None
-    printer_2_data = None
-    
-    if result_printer_1["success"]:
-        success_count += 1
-        printer_1_data = result_printer_1["data"]
-    else:
-        error_messages.append(f"Printer 1: {result_printer_1['message']}")
-    
-    if result_printer_2["success"]:
-        success_count += 1
-        printer_2_data = result_printer_2["data"]
-    else:
-        error_messages.append(f"Printer 2: {result_printer_2['message']}")
+    for printer, result in zip(printers, results):
+        if result["success"]:
+            printer_data.append((printer, result["data"]))
+        else:
+            error_messages.append(f"{printer['name']}: {result['message']}")
 
     # ส่งทั้ง flex message และ text message
-    if success_count > 0:
-        handle_flex_message(printer_1_data, printer_2_data)
+    if printer_data:
+        extra_messages = []
+        if FORECAST_IN_DAILY:
+            forecast_text = forecast_summary_text([printer["name"] for printer, _ in printer_data])
+            if forecast_text:
+                from linebot.v3.messaging import TextMessage
+                extra_messages.append(TextMessage(text=forecast_text))
+        handle_flex_message(printer_data, extra_messages)
         
         if error_messages:
             error_text = "❌ มีปัญหากับเครื่องพิมพ์:\n" + "\n".join(error_messages)
@@ -496,45 +2917,198 @@ def job_7am():
         error_text = "❌ ไม่สามารถเชื่อมต่อกับเครื่องพิมพ์ได้:\n" + "\n".join(error_messages)
         send_text_message(error_text)
 
-def job_check_connection():
-    """ทำงานเวลา 7:30-16:30 น. - แจ้งเตือนเฉพาะเมื่อเชื่อมต่อไม่ได้"""
-    result_printer_1 = checkNetworkPrinter(printer_1_url, worksheet_printer_1)
-    result_printer_2 = checkNetworkPrinter(printer_2_url, worksheet_printer_2)
-    
-    error_messages = []
-    
-    if not result_printer_1["success"]:
-        error_messages.append(f"❌ Printer 1: {result_printer_1['message']}")
-    
-    if not result_printer_2["success"]:
-        error_messages.append(f"❌ Printer 2: {result_printer_2['message']}")
+# ---- Adaptive poll scheduler ----
+# แต่ละเครื่องมี job ของตัวเองที่ตั้งเวลารอบถัดไปใหม่ทุกครั้งหลังตรวจสอบ
+#   up (นิ่งมานาน) = poll_interval * HEALTHY_INTERVAL_FACTOR
+#   degraded      = poll_interval / 4 เพื่อยืนยันผลเร็วขึ้น
+#   down          = poll_interval * 2^n (exponential backoff) ไม่เกิน MAX_POLL_BACKOFF
+# สุ่มเวลา ±POLL_JITTER เพื่อไม่ให้ทุกเครื่องยิงพร้อมกัน และตรวจเฉพาะใน poll_hours/poll_days
+# เครื่องที่ตั้ง "adaptive": false ใน printers.json จะตรวจทุก poll_interval เสมอ
+# job ที่พลาดเวลา (executor ไม่ว่าง, เครื่องหลับ) จะรันทันทีที่ทำได้ และมี watchdog คอยเพิ่ม job ที่หายไปกลับมา
+# ถ้าเครื่องถูกตรวจไปแล้วหลังตั้งเวลา (รายงาน 07:00 หรือ /check) job จะไม่ตรวจซ้ำแต่ตั้งรอบถัดไปต่อ
+HEALTHY_INTERVAL_FACTOR = float(os.getenv("HEALTHY_INTERVAL_FACTOR", "2"))
+MAX_POLL_BACKOFF = int(os.getenv("MAX_POLL_BACKOFF", str(4 * 3600)))
+MIN_POLL_INTERVAL = 60
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
+POLL_WATCHDOG_SECONDS = int(os.getenv("POLL_WATCHDOG_SECONDS", "600"))
 
-    if error_messages:
-        error_text = "⚠️ แจ้งเตือนปัญหาเครื่องพิมพ์:\n" + "\n".join(error_messages)
-        send_text_message(error_text)
-    else:
-        print("✅ ทุกเครื่องพิมพ์เชื่อมต่อได้ปกติ - ไม่ส่งข้อความ")
+_scheduler = None
+_poll_windows = {}
 
-if __name__ == '__main__':
-    import uvicorn
-    
-    scheduler = BackgroundScheduler(timezone=tz)
+def _poll_window(printer):
+    key = (printer["poll_hours"], printer["poll_days"])
+    if key not in _poll_windows:
+        from apscheduler.triggers.cron import CronTrigger
+        _poll_windows[key] = CronTrigger(hour=key[0], minute="*", day_of_week=key[1], timezone=tz)
+    return _poll_windows[key]
+
+def next_poll_delay(printer, state, now=None):
+    """คำนวณระยะเวลา (วินาที) ถึงรอบตรวจสอบถัดไปของเครื่องพิมพ์จากสถานะล่าสุด"""
+    now = now or time.time()
+    base = printer["poll_interval"]
+    delay = base
+    if printer["adaptive"] and state is not None and not state["flapping"]:
+        if state["state"] == "down":
+            exponent = max(0, state["fail_count"] - DOWN_AFTER)
+            delay = min(base * (2 ** min(exponent, 16)), max(MAX_POLL_BACKOFF, base))
+        elif state["state"] == "degraded":
+            delay = base / 4
+        elif state["changed_at"] is None or now - state["changed_at"] >= base * 3:
+            delay = base * HEALTHY_INTERVAL_FACTOR
+    delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+    return max(MIN_POLL_INTERVAL, delay)
 
-    # 7:00 น. เฉพาะวันจันทร์-ศุกร์
-    scheduler.add_job(job_7am, CronTrigger(hour=7, minute=0, day_of_week='mon-fri', timezone=tz))
+def next_poll_time(printer, state, now=None):
+    """เวลาตรวจสอบรอบถัดไป ถ้าตกนอกช่วงเวลาทำงาน จะเลื่อนไปต้นช่วงถัดไป (พร้อม jitter)"""
+    now = datetime.now(tz) if now is None else now
+    candidate = now + timedelta(seconds=next_poll_delay(printer, state, now.timestamp()))
+    return _align_to_window(printer, candidate)
 
-    # 7:30-16:30 น. ทุกชั่วโมงที่ 30 นาที เฉพาะวันจันทร์-ศุกร์
-    scheduler.add_job(job_check_connection, CronTrigger(hour='7-16', minute=30, day_of_week='mon-fri', timezone=tz))
+def _align_to_window(printer, candidate):
+    """คืนค่า candidate ถ้าอยู่ในช่วงเวลาทำงาน ไม่งั้นเลื่อนไปต้นช่วงถัดไป"""
+    minute = candidate.replace(second=0, microsecond=0)
+    run_date = _poll_window(printer).get_next_fire_time(None, minute)
+    if run_date is None or run_date == minute:
+        return candidate
+    # ต้นช่วงเวลาทำงาน ทุกเครื่องจะตรงกันหมด จึงกระจายออกไปสูงสุด 5 นาที
+    return run_date + timedelta(seconds=random.uniform(0, min(300, printer["poll_interval"])))
 
+def get_last_polled(name):
+    """เวลา (unix timestamp) ที่เครื่องนี้ถูกตรวจครั้งล่าสุดจากทุก worker หรือ None"""
+    row = get_db().execute('SELECT ts FROM printer_snapshot WHERE printer = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+def poll_printer_job(name, scheduled_at=None):
+    """
+    job ของ scheduler: ตรวจสอบเครื่องพิมพ์หนึ่งเครื่องแล้วตั้งเวลารอบถัดไป
+    scheduled_at = เวลาที่ตั้ง job นี้ ถ้ามีการตรวจหลังจากนั้นแล้วจะไม่ตรวจซ้ำ
+    """
+    printer = get_printer(name)
+    if printer is None:
+        return
+    try:
+        # รอรายงาน 07:00 (หรือ /check) ที่กำลังตรวจทุกเครื่องอยู่ให้เสร็จก่อน แล้วค่อยดูว่าต้องตรวจอีกไหม
+        with process_lock("job_7am"):
+            pass
+        last_polled = get_last_polled(name)
+        if scheduled_at is None or last_polled is None or last_polled < scheduled_at:
+            poll_printers([printer])
+    finally:
+        schedule_printer_poll(printer)
+
+def schedule_printer_poll(printer, run_date=None):
+    from apscheduler.triggers.date import DateTrigger
+    if run_date is None:
+        run_date = next_poll_time(printer, get_printer_state(printer["name"]))
+    # misfire_grace_time=None: รันช้าดีกว่าข้าม เพราะ job ที่ถูกข้ามจะไม่ได้ตั้งรอบถัดไป
+    _scheduler.add_job(
+        poll_printer_job, DateTrigger(run_date=run_date, timezone=tz),
+        args=[printer["name"], time.time()], id=f"poll:{printer['name']}",
+        replace_existing=True, misfire_grace_time=None, coalesce=True
+    )
+
+def ensure_poll_jobs():
+    """watchdog: ตั้ง job ให้เครื่องที่ไม่มี job ตรวจสอบ (เช่นตั้งรอบถัดไปไม่สำเร็จ)"""
+    for printer in PRINTERS.values():
+        if _scheduler.get_job(f"poll:{printer['name']}") is None:
+            print(f"Poll job for {printer['name']} missing, rescheduling")
+            try:
+                schedule_printer_poll(printer)
+            except Exception as e:
+                print(f"Error rescheduling {printer['name']}: {e}")
+
+def create_scheduler():
+    """สร้าง scheduler: รายงาน 07:00 และ job ตรวจสอบแยกต่อเครื่องพิมพ์"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+    global _scheduler
+    _scheduler = BackgroundScheduler(timezone=tz)
+
+    # 7:00 น. เฉพาะวันจันทร์-ศุกร์ (ถือ lock เดียวกับ /check ให้ job ของแต่ละเครื่องรอจนเสร็จ)
+    _scheduler.add_job(
+        run_exclusive, CronTrigger(hour=7, minute=0, day_of_week='mon-fri', timezone=tz),
+        args=["job_7am", job_7am]
+    )
+    if ROLLUP_WEEKLY_SUMMARY:
+        # สรุปสัปดาห์ที่แล้วทุกวันจันทร์ 7:05 น.
+        _scheduler.add_job(job_weekly_summary, CronTrigger(hour=7, minute=5, day_of_week='mon', timezone=tz))
+
+    now = datetime.now(tz)
+    for printer in PRINTERS.values():
+        # รอบแรกกระจายเวลาไม่ให้ทุกเครื่องเริ่มพร้อมกัน
+        start = now + timedelta(seconds=random.uniform(0, min(60, printer["poll_interval"])))
+        schedule_printer_poll(printer, _align_to_window(printer, start))
+    _scheduler.add_job(ensure_poll_jobs, IntervalTrigger(seconds=POLL_WATCHDOG_SECONDS, timezone=tz))
+    return _scheduler
+
+# ---- Leader election ----
+def _start_leader_duties():
+    """งานที่ต้องมีแค่ process เดียว: scheduler และการสร้าง rollup ครั้งแรก"""
+    threading.Thread(target=_rebuild_rollups_if_empty, name="rollup-backfill", daemon=True).start()
+    scheduler = create_scheduler()
     scheduler.start()
+    print(f"👑 Worker {os.getpid()} เป็น leader เริ่ม scheduler แล้ว")
+
+def _start_outbox_duties():
+    start_outbox_worker()
+    print(f"📤 Worker {os.getpid()} เป็น leader ของ outbox เริ่มส่งงานแล้ว")
+
+async def _leader_retry_loop(role, start_duties):
+    while not try_become_leader(role):
+        await asyncio.sleep(LEADER_RETRY_SECONDS)
+    start_duties()
+
+@app.on_event("startup")
+async def start_leader_election():
+    roles = []
+    if SCHEDULER_ENABLED:
+        roles.append(("scheduler", _start_leader_duties))
+    if OUTBOX_ENABLED:
+        roles.append(("outbox", _start_outbox_duties))
+    else:
+        print("⚠️ OUTBOX_ENABLED=false: worker นี้จะไม่ส่ง row ของ Google Sheets และข้อความ LINE ที่ค้างใน outbox")
+    for role, start_duties in roles:
+        if try_become_leader(role):
+            start_duties()
+        else:
+            print(f"Worker {os.getpid()} รอเป็น leader ของ {role} (ลองใหม่ทุก {LEADER_RETRY_SECONDS:g} วินาที)")
+            asyncio.create_task(_leader_retry_loop(role, start_duties))
+
+@app.on_event("shutdown")
+def stop_scheduler():
+    if _scheduler is not None and _scheduler.running:
+        _scheduler.shutdown(wait=False)
+
+# ---- Startup timing ----
+# วัดเวลาตั้งแต่เริ่ม import main.py จนพร้อมรับ request ดูได้ที่ /stats และ /metrics
+_startup_timings = {
+    "import_seconds": round(time.perf_counter() - _IMPORT_STARTED, 4),
+    "ready_seconds": None,
+}
+
+@app.on_event("startup")
+async def record_startup_time():
+    _startup_timings["ready_seconds"] = round(time.perf_counter() - _IMPORT_STARTED, 4)
+    print(f"🚀 Startup: import {_startup_timings['import_seconds']}s, ready {_startup_timings['ready_seconds']}s")
+
+def get_startup_timings():
+    return dict(_startup_timings)
+
+if __name__ == '__main__':
+    import uvicorn
 
     print("เริ่มทำงาน scheduler และ web server แล้ว...")
     print("📅 ตารางงาน:")
     print("   - 07:00 น. (จันทร์-ศุกร์) = ส่งข้อมูลสถานะเครื่องพิมพ์แบบเต็ม (Flex + Text)")
-    print("   - 07:30-16:30 น. (จันทร์-ศุกร์ ทุกชั่วโมง) = แจ้งเตือนเฉพาะเมื่อเชื่อมต่อไม่ได้ (Text)")
+    print(f"   - {POLL_HOURS} น. ({POLL_DAYS}) = ตรวจสอบแต่ละเครื่องตามรอบของเครื่องนั้น แจ้งเตือนเมื่อสถานะเปลี่ยน (Text)")
+    if ROLLUP_WEEKLY_SUMMARY:
+        print("   - 07:05 น. (จันทร์) = สรุปการใช้งานสัปดาห์ที่แล้ว (Text)")
 
-    try:
+    # scheduler เริ่มใน startup event ของ worker ที่เป็น leader และหยุดใน shutdown event
+    if WEB_CONCURRENCY > 1:
+        print(f"🧵 API {WEB_CONCURRENCY} workers (scheduler ทำงานใน worker เดียว)")
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WEB_CONCURRENCY)
+    else:
         uvicorn.run(app, host="0.0.0.0", port=8000)
-    except KeyboardInterrupt:
-        scheduler.shutdown()
-        print("หยุดการทำงานแล้ว")
\ No newline at end of file
+    print("หยุดการทำงานแล้ว")